@@ -9,6 +9,11 @@ aws s3 rm s3://$1/modify_config_recorder.zip
 aws s3 rm s3://$1/modify_delivery_channel.zip
 aws s3 rm s3://$1/modify_aggr_authorizations.zip
 aws s3 rm s3://$1/start_config_recorder.zip
+aws s3 rm s3://$1/config_inventory.zip
+aws s3 rm s3://$1/inventory_updater.zip
+aws s3 rm s3://$1/enroll_account.zip
+aws s3 rm s3://$1/inventory_notifications.yaml
+aws s3 rm s3://$1/organizations_events_forwarder.yaml
 aws s3 rm s3://$1/modify_config_sm4.json
 aws s3 rm s3://$1/setup-config-sf11.yaml
 aws s3 rm s3://$1/org_configrecorder.yaml
@@ -0,0 +1,41 @@
+import logging
+import client_pool
+import region_fanout
+
+#
+# Reconciles aggregation authorizations as sets of (authorized account,
+# authorized region) pairs. Each member region is described once and only
+# the missing pairs are put, so a converged account costs one read per
+# region and no writes.
+#
+LOGGER = logging.getLogger()
+
+def required_pairs(authorized_account, authorized_regions):
+    return set([ (authorized_account, authorized_region) for authorized_region in authorized_regions ])
+
+def existing_pairs(config_client):
+    pairs = set()
+    paginator = config_client.get_paginator('describe_aggregation_authorizations')
+    for page in paginator.paginate():
+        for auth in page['AggregationAuthorizations']:
+            pairs.add((auth['AuthorizedAccountId'], auth['AuthorizedAwsRegion']))
+    return pairs
+
+def reconcile_region(config_client, required):
+    # returns the sorted list of pairs that were missing and have been put
+    missing = sorted(required - existing_pairs(config_client))
+    for (authorized_account, authorized_region) in missing:
+        config_client.put_aggregation_authorization(
+            AuthorizedAccountId=authorized_account,
+            AuthorizedAwsRegion=authorized_region
+        )
+    return missing
+
+def reconcile_regions(member_session, account_id, regions, required, max_workers=None):
+    # returns ({ region: [put pairs] }, { region: exception })
+    def reconcile(region):
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        missing = reconcile_region(config_client, required)
+        LOGGER.info(f"Put {len(missing)} of {len(required)} Aggregation Authorizations for Account {account_id} in Region {region}")
+        return missing
+    return region_fanout.map_regions_collect(reconcile, regions, max_workers)
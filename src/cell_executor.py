@@ -0,0 +1,72 @@
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#
+# Bounded work-queue for (account, region) cells. The steps of one cell run
+# in order on one worker; different cells run concurrently, limited by a
+# global worker count and a per-account in-flight count. An optional
+# concurrency controller lowers the global count while APIs throttle.
+#
+default_cell_workers = int(os.environ.get('cell_workers', 16))
+default_account_workers = int(os.environ.get('account_workers', 4))
+
+LOGGER = logging.getLogger()
+
+def run_cell_steps(account_id, region, steps):
+    results = []
+    for step in steps:
+        LOGGER.info(f"Running {step.__name__} for Account {account_id} in Region {region}")
+        try:
+            results.append(step(account_id, region))
+        except Exception:
+            # the later steps of the cell are skipped
+            LOGGER.error(f"{step.__name__} failed for Account {account_id} in Region {region}")
+            raise
+    return results
+
+def run_cells(cells, steps, max_workers=None, max_per_account=None, controller=None):
+    # cells: [ (account_id, region) ], steps: [ step(account_id, region) ]
+    # returns ({ cell: [step results] }, { cell: exception })
+    if max_workers is None:
+        max_workers = default_cell_workers
+    if max_per_account is None:
+        max_per_account = default_account_workers
+    max_workers = max(1, max_workers)
+    max_per_account = max(1, max_per_account)
+    results = {}
+    errors = {}
+    pending = deque(cells)
+    in_flight = {}
+    account_in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or in_flight:
+            # admit cells in queue order, skipping accounts at their limit
+            deferred = deque()
+            limit = max_workers if controller is None else max(1, min(max_workers, controller.limit()))
+            while pending and len(in_flight) < limit:
+                cell = pending.popleft()
+                account_id = cell[0]
+                if account_in_flight.get(account_id, 0) >= max_per_account:
+                    deferred.append(cell)
+                    continue
+                account_in_flight[account_id] = account_in_flight.get(account_id, 0) + 1
+                future = executor.submit(run_cell_steps, cell[0], cell[1], steps)
+                in_flight[future] = cell
+            deferred.extend(pending)
+            pending = deferred
+            done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                cell = in_flight.pop(future)
+                account_in_flight[cell[0]] -= 1
+                try:
+                    results[cell] = future.result()
+                    if controller is not None:
+                        controller.on_success()
+                except Exception as ex:
+                    if controller is not None:
+                        controller.on_failure(ex)
+                    LOGGER.error(f"Account {cell[0]} in Region {cell[1]} failed: {str(ex)}")
+                    errors[cell] = ex
+    return (results, errors)
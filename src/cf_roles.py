@@ -7,6 +7,10 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import threading
+import session_cache
+import client_pool
+import work_fanout
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -15,30 +19,56 @@ if 'log_level' in os.environ:
 else:
     LOGGER.setLevel(logging.ERROR)
 
+admin_role_name = 'AWSCloudFormationStackSetAdministrationRole'
+exec_role_name = 'AWSCloudFormationStackSetExecutionRole'
+role_cache_ttl_seconds = int(os.environ.get('role_cache_ttl_seconds', 3600))
+
 session = boto3.Session()
 
+# { (account, role name): (checked at, True) }; only existing roles are
+# cached, a missing role is created right after the check
+_role_cache = {}
+_role_cache_lock = threading.Lock()
+
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
+def role_exists(iam_client, role_name):
+    # one GetRole call instead of paging through list_roles
+    try:
+        iam_client.get_role(RoleName=role_name)
+        return True
+    except iam_client.exceptions.NoSuchEntityException:
+        return False
+
+def cached_role_exists(account_id, role_name, iam_client_factory):
+    key = (account_id, role_name)
+    with _role_cache_lock:
+        cached = _role_cache.get(key)
+        if cached and time.time() - cached[0] <= role_cache_ttl_seconds:
+            return True
+    found = role_exists(iam_client_factory(), role_name)
+    if found:
+        with _role_cache_lock:
+            _role_cache[key] = (time.time(), True)
+    return found
+
 def check_cf_admin_role(ct_session):
-    iam_client = ct_session.client('iam')
-    paginator = iam_client.get_paginator('list_roles')
-    role_iterator = paginator.paginate()
-    role_found = True
-    for page in role_iterator:
-        for role in page['Roles']:
-            if role['RoleName'] and role['RoleName'] == 'AWSCloudFormationStackSetAdministrationRole':
-                role_found = True
-                break
-        if role_found:
-            break
-    return role_found
+    return cached_role_exists(session_cache.get_account_id(), admin_role_name, lambda: client_pool.get_client(ct_session, 'iam'))
+
+def check_cf_exec_roles(account_ids, role_name=exec_role_name):
+    # returns ({ account: True/False }, { account: exception }), the member
+    # accounts are probed concurrently
+    assume_role_name = os.environ['assume_role']
+    def check(account_id):
+        return cached_role_exists(account_id, role_name, lambda: client_pool.get_client(assume_role(account_id, assume_role_name), 'iam'))
+    return work_fanout.map_collect(list(account_ids), check, label='Account')
 
 def create_cf_admin_role(ct_session, s3bucket):
-    cf_client = ct_session.client('cloudformation')
-    stackName = 'AWSCloudFormationStackSetAdministrationRole'
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
+    stackName = admin_role_name
     template_url = 'https://s3.amazonaws.com/'+s3bucket+'/'+stackName+'.yml'
     create_response = {}
     try:
@@ -56,10 +86,10 @@ def create_cf_admin_role(ct_session, s3bucket):
         raise SystemExit()
 
 def create_cf_exec_role(master_account_id, account_id, s3bucket):
-    stackName = 'AWSCloudFormationStackSetExecutionRole'
+    stackName = exec_role_name
     roleName = os.environ['assume_role']
     member_session = assume_role(account_id, roleName)
-    cf_client = member_session.client('cloudformation')
+    cf_client = client_pool.get_client(member_session, 'cloudformation')
     template_url = 'https://s3.amazonaws.com/'+s3bucket+'/'+stackName+'.yml'
     parameter = {
         'ParameterKey': 'AdministratorAccountId',
@@ -82,7 +112,7 @@ def create_cf_exec_role(master_account_id, account_id, s3bucket):
         raise SystemExit()
 
 def wait_on_stack(session, stackName):
-    cf_client = session.client('cloudformation')
+    cf_client = client_pool.get_client(session, 'cloudformation')
     try:
         waiter = cf_client.waiter('stack_create_complete')
         waiter.wait(
@@ -95,28 +125,22 @@ def wait_on_stack(session, stackName):
         raise SystemExit()
 
 def assume_role(aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=os.environ['org_id']
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(os.environ['org_id'], aws_account_number, role_name)
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
     s3bucket = os.environ['S3Bucket']
-    member_account_id = os.environ['member_account']
-    master_account_id = boto3.client('sts').get_caller_identity()['Account']
+    member_account_ids = event.get('member_accounts') or [ os.environ['member_account'] ]
+    master_account_id = session_cache.get_account_id()
     if not check_cf_admin_role(session):
         create_cf_admin_role(session, s3bucket)
-    create_cf_exec_role(master_account_id, member_account_id, s3bucket)
+    (exec_roles, errors) = check_cf_exec_roles(member_account_ids)
+    for account_id in errors:
+        LOGGER.error(f"Role check failed for Account {account_id}: {str(errors[account_id])}")
+    for account_id in member_account_ids:
+        if account_id in errors:
+            continue
+        if exec_roles[account_id]:
+            LOGGER.info(f"Role {exec_role_name} exists in Account {account_id}")
+            continue
+        create_cf_exec_role(master_account_id, account_id, s3bucket)
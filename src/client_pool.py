@@ -0,0 +1,46 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import rate_limiter
+import session_cache
+
+#
+# boto3 clients are thread-safe and expensive to build (service model
+# loading, endpoint resolution, a fresh HTTPS connection pool), so they are
+# pooled at module scope and reused across warm Lambda invocations.
+#
+client_pool_size = int(os.environ.get('client_pool_size', 128))
+
+LOGGER = logging.getLogger()
+
+_client_pool = OrderedDict()
+_client_pool_lock = threading.Lock()
+
+def _client_key(client_session, service_name, kwargs):
+    # the credentials object is shared by all clients of a session and
+    # survives credential refresh, so it identifies the caller
+    credentials = client_session.get_credentials()
+    return (id(credentials), service_name, tuple(sorted(kwargs.items())))
+
+def get_client(client_session, service_name, **kwargs):
+    key = _client_key(client_session, service_name, kwargs)
+    with _client_pool_lock:
+        entry = _client_pool.get(key)
+        if entry is not None:
+            _client_pool.move_to_end(key)
+            return entry[1]
+    client = client_session.client(service_name, **kwargs)
+    rate_limiter.attach(client, session_cache.get_session_account(client_session))
+    with _client_pool_lock:
+        # another thread may have built the same client meanwhile
+        entry = _client_pool.setdefault(key, (client_session, client))
+        _client_pool.move_to_end(key)
+        while len(_client_pool) > client_pool_size:
+            evicted_key, evicted = _client_pool.popitem(last=False)
+            LOGGER.info(f"Evicted {evicted_key[1]} client from client pool")
+    return entry[1]
+
+def clear():
+    with _client_pool_lock:
+        _client_pool.clear()
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import logging
+import threading
+import rate_limiter
+
+#
+# Additive-increase / multiplicative-decrease limit for the number of work
+# items in flight. Every completed item raises the limit by increase/limit,
+# about one more worker per round of work, and a throttled API call cuts it
+# by the decrease factor, at most once per cooldown. Throttles are reported
+# by the rate_limiter hook of every pooled client while the controller is
+# active, and by the executors for work items that failed on a throttle
+# once retries were exhausted. Other failures leave the limit unchanged.
+# The live limit is published as a CloudWatch metric through the embedded
+# metric format.
+#
+metrics_namespace = os.environ.get('metrics_namespace', 'ConfigEnabler')
+initial_workers = int(os.environ.get('initial_workers', 4))
+decrease_cooldown_seconds = float(os.environ.get('decrease_cooldown_seconds', 2))
+
+LOGGER = logging.getLogger()
+
+class AimdController:
+    def __init__(self, name, maximum, initial=None, minimum=1, increase=1.0, decrease=0.5):
+        self.name = name
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.increase = increase
+        self.decrease = decrease
+        if initial is None:
+            initial = initial_workers
+        self._limit = float(min(self.maximum, max(minimum, initial)))
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def limit(self):
+        return int(self._limit)
+
+    def on_success(self):
+        with self._lock:
+            before = self.limit()
+            self._limit = min(float(self.maximum), self._limit + self.increase / self._limit)
+            changed = self.limit() != before
+        if changed:
+            self.emit_metric()
+
+    def on_throttle(self, service_name=None, operation_name=None):
+        with self._lock:
+            now = time.monotonic()
+            # one burst of throttles is one congestion signal
+            if now - self._last_decrease < decrease_cooldown_seconds:
+                return
+            self._last_decrease = now
+            self._limit = max(float(self.minimum), self._limit * self.decrease)
+        LOGGER.info(f"Throttled on {service_name}.{operation_name}, {self.name} concurrency limit cut to {self.limit()}")
+        self.emit_metric()
+
+    def on_failure(self, ex):
+        # a failed item never raises the limit
+        if rate_limiter.is_throttle_error(ex):
+            operation_name = getattr(ex, 'operation_name', None)
+            self.on_throttle(operation_name=operation_name)
+
+    def emit_metric(self):
+        # a bare JSON line on stdout, the Lambda log agent turns it into a metric
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': metrics_namespace,
+                    'Dimensions': [ [ 'Controller' ] ],
+                    'Metrics': [ { 'Name': 'ConcurrencyLimit', 'Unit': 'Count' } ]
+                }]
+            },
+            'Controller': self.name,
+            'ConcurrencyLimit': self.limit()
+        }))
+
+    def __enter__(self):
+        rate_limiter.add_throttle_listener(self.on_throttle)
+        self.emit_metric()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        rate_limiter.remove_throttle_listener(self.on_throttle)
+        self.emit_metric()
+        return False
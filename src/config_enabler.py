@@ -7,14 +7,16 @@ import logging
 from datetime import datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import deadline_waiter
+import stackset_deployer
+import region_discovery
+import org_index
+import cell_executor
+import concurrency_controller
+import config_state
 
-#
-# These can be parameterized. Using these for now.
-#
-stackInstanceCheckCount=120
-stackInstanceCheckFrequencySeconds=30
-stackSetCheckFrequencySeconds=30
-stackSetCheckCount=120
 org_config_recorder_name = 'aws-controltower-ConfigRecorderRole-customer-created'
 org_delivery_channel_name = 'aws-controltower-ConfigDeliveryChannel-customer-created'
 default_recorder_name = 'aws-controltower-ConfigRecorderRole'
@@ -31,23 +33,8 @@ else:
 
 session = boto3.Session()
 
-def decrement_stackset_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount = stackSetCheckCount -1
-    LOGGER.info(f"{stackSetCheckCount} more times to check ..")
-
-def decrement_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = stackInstanceCheckCount - 1
-    LOGGER.info(f"{stackInstanceCheckCount} more times to check ..")
-
-def reset_stackcheck_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount=120
-
-def reset_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = 120
+class ModifyConfigFailed(Exception):
+    pass
 
 def send(event, context, response_status, response_data, physical_resource_id=None, no_echo=False):
     response_url = event['ResponseURL']
@@ -77,111 +64,37 @@ def send(event, context, response_status, response_data, physical_resource_id=No
         print("send(..) failed executing requests.put(..): "+str(ex))
 
 def get_ct_regions(ct_session):
-    cf = ct_session.client('cloudformation')
-    region_set = set()
-    try:
-        # stack instances are outdated
-        stacks = cf.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            LOGGER.info(f"Region: {stack['Region']}")
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.warning(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return region_discovery.get_ct_regions(ct_session)
 
 def get_ou(account_id):
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
-    list_parents_response = org_client.list_parents(ChildId=account_id)
-    parent_id = list_parents_response['Parents'][0]['Id']
-    parent_type = list_parents_response['Parents'][0]['Type']
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
+    (parent_id, parent_type) = org_index.get_parent(org_client, account_id)
     if parent_type != 'ROOT':
         return parent_id
     return None
 
 def is_valid_ou(ou_id):
     valid_ou = False
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
     try:
-        root_response = org_client.list_roots()
-        if root_response['Roots']:
-            root_id = root_response['Roots'][0]['Id']
-            LOGGER.info(f"List Organizational Units for Root {root_id} ..")
-            paginator = org_client.get_paginator('list_children')
-            iterator = paginator.paginate(ParentId=root_id, ChildType='ORGANIZATIONAL_UNIT')
-            for page in iterator:
-                for ou in page['Children']:
-                    if ou['Id'] == ou_id:
-                        valid_ou = True
-                        break
+        valid_ou = org_index.ou_exists(org_client, ou_id)
     except Exception as ex:
-        LOGGER.error(f"Error in call org_client.list_children(..)")
+        LOGGER.error(f"Error in building Organization index")
+        LOGGER.error(str(ex))
     return valid_ou
 
 def get_ou_accounts(ou_id):
     accounts = []
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
     try:
-        response = org_client.list_accounts_for_parent(ParentId=ou_id)
-        for account in response['Accounts']:
-            if account['Id']:
-                accounts.append(account['Id'])
+        accounts = org_index.get_ou_accounts(org_client, ou_id)
     except Exception as ex:
-        LOGGER.error(f"Error in call list_accounts_for_parent(..) for Organizational Unit {ou_id}")
-    return accounts
-
-def wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-    global stackInstanceCheckCount
-    time.sleep(stackInstanceCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
-    try:
-        response = cf_client.describe_stack_instance(
-            StackSetName=stackSetName,
-            StackInstanceAccount=accountId,
-            StackInstanceRegion=region,
-            CallAs='SELF'
-        )
-        if response['StackInstance']:
-            if response['StackInstance']['Status'] == 'CURRENT':
-                return True
-    except Exception as ex:
-        LOGGER.error(f"Failed in call describe_stack_instance(..) for StackSet {stackSetName} for Account {accountId} in Region {region}")
+        LOGGER.error(f"Error in listing accounts for Organizational Unit {ou_id}")
         LOGGER.error(str(ex))
-    return False
-
-def create_ct_exec_role(ct_session, accountId, region):
-    cf_client = ct_session.client('cloudformation')
-    stackSetName = 'AWSControlTowerExecutionRole'
-    try:
-        # get stackset
-        # CallAs = 'SELF' since running from Org Management Account
-        ou_id = get_ou(accountId)
-        targets = {
-            'OrganizationalUnitIds': [ ou_id ]
-        }
-        response = cf_client.create_stack_instances(
-            StackSetName=stackSetName,
-            DeploymentTargets=targets,
-            Regions=[region],
-            CallAs='SELF'
-        )
-        LOGGER.info(f"Stack Instance launched for StackSet {stackSetName} with OperationId: {response['OperationId']}")
-    except Exception as ex:
-        LOGGER.error(f"Create Stack Instance for StackSet {stackSetName} failed !")
-        LOGGER.error(str(ex))
-    # check stack instance is availabe
-    while stackInstanceCheckCount > 0:
-        if wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-            LOGGER.info(f"Stack Instance for StackSet {stackSetName} found in Account {accountId} in Region {region}")
-            break
-        decrement_stackinstance_check_count()
+    return accounts
 
 def wait_for_stackset(ct_session):
-    global stackSetCheckCount
-    time.sleep(stackSetCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_set(StackSetName=kyndryConfigRecorderRoleStackSetName)
         if response['StackSet']:
@@ -192,8 +105,9 @@ def wait_for_stackset(ct_session):
         LOGGER.error(str(ex))
     return False
 
-def create_configrecorder_role(ct_session, accountId, region, s3bucket, s3key):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_stackset(ct_session, s3bucket, s3key, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     templateUrl = 'https://s3.amazonaws.com/'+s3bucket+'/'+s3key    
     try:
         create_response = cf_client.create_stack_set(
@@ -211,69 +125,39 @@ def create_configrecorder_role(ct_session, accountId, region, s3bucket, s3key):
         LOGGER.error(f"Create StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
     # check StackSet status
-    while stackSetCheckCount > 0:
-        if wait_for_stackset(ct_session):
-            break
-        decrement_stackset_check_count()
+    waiter.wait(lambda: wait_for_stackset(ct_session), f"StackSet {kyndryConfigRecorderRoleStackSetName}")
+
+def deploy_member_roles(ct_session, accounts, region, s3bucket, s3key, waiter=None):
+    # AWSControlTowerExecutionRole and MyOrgConfigRecorderRole are deployed
+    # to all parent OUs of the accounts with one operation per StackSet
+    waiter = waiter or deadline_waiter.Waiter()
+    account_ous = { accountId: get_ou(accountId) for accountId in accounts }
+    ou_ids = sorted(set(account_ous.values()) - set([ None ]))
+    create_configrecorder_stackset(ct_session, s3bucket, s3key, waiter)
+    targets = []
+    for ou_id in ou_ids:
+        targets.append(('AWSControlTowerExecutionRole', ou_id, region))
+        targets.append((kyndryConfigRecorderRoleStackSetName, ou_id, region))
     try:
-        ou_id = get_ou(accountId)
-        LOGGER.info(f"Launching StackSet {kyndryConfigRecorderRoleStackSetName} for Organizational Unit: {ou_id} in Region {region} ..")
-        targets = {
-            'OrganizationalUnitIds': [ ou_id ]
-        }
-        launch_response = cf_client.create_stack_instances(
-            StackSetName=kyndryConfigRecorderRoleStackSetName,
-            DeploymentTargets=targets,
-            Regions=[ region ]
-        )
-        LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} launched with Operation Id: {launch_response['OperationId']}")
+        plan = stackset_deployer.plan_deployments(targets)
+        stackset_deployer.deploy(ct_session, plan, waiter)
     except Exception as ex:
-        LOGGER.error(f"Launch of StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
+        LOGGER.error(f"Launch of StackInstances for Organizational Units {ou_ids} in Region {region} failed !")
         LOGGER.error(str(ex))
+        return
+    # Wait on Role creation in all accounts of the targeted OUs at once
+    ou_member_accounts = [ accountId for accountId in accounts if account_ous[accountId] is not None ]
+    statuses = stackset_deployer.wait_for_instances(ct_session, [ 'AWSControlTowerExecutionRole', kyndryConfigRecorderRoleStackSetName ], ou_member_accounts, region, waiter)
+    for (stack_set_name, accountId) in sorted(statuses):
+        if statuses[(stack_set_name, accountId)] != 'SUCCEEDED':
+            LOGGER.error(f"StackSet {stack_set_name} instance in Account {accountId} in Region {region} ended with status: {statuses[(stack_set_name, accountId)]}")
 
 def assume_role(aws_account_number, role_name):
-    #sts_client = boto3.client('sts', region_name=os.environ['AWS_REGION'],
-    #    endpoint_url=f"https://sts.{os.environ['AWS_REGION']}.amazonaws.com")
-    #partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    #current_account = sts_client.get_caller_identity()['Arn'].split(":")[4]
-    #if aws_account_number == current_account:
-    #    LOGGER.info(f"Using existing region_session for Account {aws_account_number}")
-    #    return session
-    #else:
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=os.environ['org_id']
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
-
-def get_ct_regions(ct_session):
-    cf_client = ct_session.client('cloudformation')
-    region_set = set()
-    try:
-        stacks = cf_client.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.error(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return session_cache.get_member_session(os.environ['org_id'], aws_account_number, role_name)
 
 def is_ct_config_recorder(accountId, recorder):
     defaultRoleArn = 'arn:aws:iam::{}:role/{}'.format(accountId, default_recorder_name)
-    orgRoleArn = org_config_recorder_name.format(accountId, org_config_recorder_name)
+    orgRoleArn = 'arn:aws:iam::{}:role/{}'.format(accountId, org_config_recorder_name)
     if recorder['roleARN'] == defaultRoleArn or recorder['roleARN'] == orgRoleArn:
         return True
     return False
@@ -285,135 +169,53 @@ def is_ct_delivery_channel(accountId, region, channel):
         return True
     return False
 
-def wait_on_stack(ct_session, accountId, region):
-    cf_client = ct_session.client('cloudformation', endpoint_url=f"https://cloudformation.{region}.amazonaws.com", region_name=region)
-    try:
-        list_response = cf_client.list_stack_instances(
-            StackSetName=kyndryConfigRecorderRoleStackSetName,
-            StackInstanceAccount=accountId,
-            StackInstanceRegion=region)
-        if len(list_response['Summaries']) > 0:
-            stackId = list_response['Summaries'][0]['StackId']
-            waiter = cf_client.get_waiter('stack_create_complete')
-            LOGGER.info(f"Waiting on Stack {stackId} in Account {accountId} for CREATE_COMPLETE status..")
-            waiter.wait(StackName=stackId)
-    except Exception as ex:
-        LOGGER.error(f"Failed while waiting on {stackId} status=CREATE_COMPLETE for Account {accountId} in Region {region}")
-        LOGGER.error(str(ex))
-
-
-def update_member_recorder(accountId, ct_regions):
+def update_member_recorder(accountId, region):
     roleArn = 'arn:aws:iam::{}:role/{}'.format(accountId, org_config_recorder_name)
     member_session = assume_role(accountId, os.environ['assume_role'])
-    for region in ct_regions:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
-        recorders_response = config_client.describe_configuration_recorders()
-        if len(recorders_response['ConfigurationRecorders']) > 0:
-            # update 1st recorder
-            recorder_name = recorders_response['ConfigurationRecorders'][0]['name']
-            recorder_dict = {
-                'name': recorder_name,
-                'roleARN': roleArn,
-                'recordingGroup': {
-                    'allSupported': True,
-                    'includeGlobalResourceTypes': True
-                }
-            }
-            try:
-                config_client.put_configuration_recorder(ConfigurationRecorder=recorder_dict)
-            except Exception as ex:
-                LOGGER.error(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
-                LOGGER.error(str(ex))
-        else:
-            # no configuration recorder, so create it
-            LOGGER.info(f"No configuration recorder found for Account {accountId} in Region {region}. Creating it now.")
-            create_member_config_recorder(config_client, accountId, region, roleArn)
-
-def update_member_channel(accountId, ct_regions):
+    config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+    recorder_dict = config_state.recorder_document(org_config_recorder_name, roleArn)
+    # a recorder on a Control Tower role with the target recording group is left as it is
+    converged = lambda recorder: is_ct_config_recorder(accountId, recorder) and config_state.recording_group_matches(recorder, recorder_dict)
+    # failures propagate so that run_cells records the cell and skips its later steps
+    return config_state.reconcile_recorder(config_client, recorder_dict, converged)
+
+def update_member_channel(accountId, region):
     s3BucketName = ct_log_bucket.format(os.environ['logarchive_account'], os.environ['ct_home_region'])
+    snsTopicARN = topicArn.format(region, os.environ['audit_account'])
     member_session = assume_role(accountId, os.environ['assume_role'])
-    for region in ct_regions:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
-        channels_response = config_client.describe_delivery_channels()
-        if len(channels_response['DeliveryChannels']) > 0:
-            # update delivery channel
-            snsTopicARN = topicArn.format(region, os.environ['audit_account'])
-            channel_name = channels_response['DeliveryChannels'][0]['name']
-            channel_dict = {
-                'name': channel_name,
-                's3BucketName': s3BucketName,
-                's3KeyPrefix': os.environ['org_id'],
-                'snsTopicARN': snsTopicARN,
-                'configSnapshotDeliveryProperties': {
-                    'deliveryFrequency': 'TwentyFour_Hours'
-                }
-            }
-            try:
-                config_client.put_delivery_channel(
-                    DeliveryChannel=channel_dict
-                )
-            except Exception as ex:
-                LOGGER.error(f"put_delivery_channel(..) call failed for Account {accountId} in Region {region}")
-                LOGGER.error(str(ex))
-        else:
-            # no delivery channel, so create it
-            LOGGER.info(f"No delivery channel found for Account {accountId} in Region {region}. Creating it now.")
-            snsTopicARN = topicArn.format(region, os.environ['audit_account'])
-            create_member_delivery_channel(config_client, accountId, region, s3BucketName, snsTopicARN)
+    config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+    channel_dict = config_state.channel_document(org_delivery_channel_name, s3BucketName, os.environ['org_id'], snsTopicARN)
+    return config_state.reconcile_channel(config_client, channel_dict, lambda channel: is_ct_delivery_channel(accountId, region, channel))
 
-def create_member_authorization(accountId, ct_regions):
+def create_member_authorization(accountId, region):
     member_session = assume_role(accountId, os.environ['assume_role'])
-    for region in ct_regions:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
-        try:
-            config_client.put_aggregation_authorization(
-                AuthorizedAccountId=os.environ['audit_account'],
-                AuthorizedAwsRegion=os.environ['ct_home_region']
-            )
-        except Exception as ex:
-            LOGGER.error(f"put_aggregation_authorization(..) failed for Account {accountId} in Region {region}")
-            LOGGER.error(str(ex))
+    config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+    config_client.put_aggregation_authorization(
+        AuthorizedAccountId=os.environ['audit_account'],
+        AuthorizedAwsRegion=os.environ['ct_home_region']
+    )
 
-def modify_member_config(accountId, ct_regions):
-        update_member_recorder(accountId, ct_regions)
-        update_member_channel(accountId, ct_regions)
-        create_member_authorization(accountId, ct_regions)
+# steps of one (account, region) cell, executed in this order
+member_config_steps = [ update_member_recorder, update_member_channel, create_member_authorization ]
+
+def modify_members_config(accounts, ct_regions):
+    cells = [ (accountId, region) for accountId in accounts for region in ct_regions ]
+    with concurrency_controller.AimdController('config_enabler', cell_executor.default_cell_workers) as controller:
+        (results, errors) = cell_executor.run_cells(cells, member_config_steps, controller=controller)
+    LOGGER.info(f"Modified Config resources in {len(results)} of {len(cells)} Account Regions")
+    for (accountId, region) in sorted(results):
+        (recorder_result, channel_result, _) = results[(accountId, region)]
+        LOGGER.info(f"Account {accountId} in Region {region}: recorder {recorder_result}, delivery channel {channel_result}")
+    for (accountId, region) in sorted(errors):
+        LOGGER.error(f"Failed to modify Config resources for Account {accountId} in Region {region}: {str(errors[(accountId, region)])}")
+    return errors
 
-def create_member_config_recorder(config_client, accountId, region, roleArn):
-    recorder_dict = {
-        'name': org_config_recorder_name,
-        'roleARN': roleArn,
-        'recordingGroup': {
-            'allSupported': True,
-            'includeGlobalResourceTypes': True
-        }
-    }
-    try:
-        config_client.put_configuration_recorder(ConfigurationRecorder=recorder_dict)
-    except Exception as ex:
-        LOGGER.error(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
-        LOGGER.error(str(ex))
-    
-def create_member_delivery_channel(config_client, accountId, region, s3BucketName, snsTopicARN):
-    channel_dict = {
-        'name': org_delivery_channel_name,
-        's3BucketName': s3BucketName,
-        's3KeyPrefix': os.environ['org_id'],
-        'snsTopicARN': snsTopicARN,
-        'configSnapshotDeliveryProperties': {
-            'deliveryFrequency': 'TwentyFour_Hours'
-        }
-    }
-    try:
-        config_client.put_delivery_channel(
-            DeliveryChannel=channel_dict
-        )
-    except Exception as ex:
-        LOGGER.error(f"put_delivery_channel(..) call failed for Account {accountId} in Region {region}")
-        LOGGER.error(str(ex))
+def modify_member_config(accountId, ct_regions):
+    return modify_members_config([ accountId ], ct_regions)
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
     partition = context.invoked_function_arn.split(":")[1]
     ou_id = os.environ['org_unit_id']
     admin_account_id = context.invoked_function_arn.split(':')[4]
@@ -428,28 +230,22 @@ def lambda_handler(event, context):
     # invocation through Template
     if 'RequestType' in event and (event['RequestType'] == 'Create' or event['RequestType'] == 'Delete' or event['RequestType'] == 'Update'):
         action = event['RequestType']
+        response_status = "SUCCESS"
         if action == 'Create':
-            for member_account_id in accounts:
-                # AWSControlTowerExecutionRole
-                create_ct_exec_role(session, member_account_id, ct_region)
-                reset_stackinstance_check_count()
-                # MyOrgConfigRecorderRole
-                create_configrecorder_role(session, member_account_id, ct_region, s3bucket, s3key)
-                # Wait on Role creation
-                wait_on_stack(session, member_account_id, ct_region)
-                # Modify Config resources on member account
-                modify_member_config(member_account_id, ct_regions)
+            # AWSControlTowerExecutionRole and MyOrgConfigRecorderRole
+            deploy_member_roles(session, accounts, ct_region, s3bucket, s3key, waiter)
+            # Modify Config resources on member accounts
+            if modify_members_config(accounts, ct_regions):
+                response_status = "FAILED"
         response_data = {}
-        send(event, context, "SUCCESS", response_data)
+        send(event, context, response_status, response_data)
         if action == "Delete":
             raise SystemExit()
     else:
-        for member_account_id in accounts:
-            # direct lambda invocation
-            create_ct_exec_role(session, member_account_id, ct_region)
-            reset_stackinstance_check_count()
-            create_configrecorder_role(session, member_account_id, ct_region, s3bucket, s3key)
-            wait_on_stack(session, member_account_id, ct_region)
-            # Modify Config resources on member account
-            modify_member_config(member_account_id, ct_regions)
+        # direct lambda invocation
+        deploy_member_roles(session, accounts, ct_region, s3bucket, s3key, waiter)
+        # Modify Config resources on member accounts
+        errors = modify_members_config(accounts, ct_regions)
+        if errors:
+            raise ModifyConfigFailed(f"Config resources not modified in {len(errors)} Account Regions: {sorted(errors)}")
 
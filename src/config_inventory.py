@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import gzip
+import boto3
+import random
+import logging
+import time
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import region_discovery
+import org_index
+import cell_executor
+import concurrency_controller
+import deadline_waiter
+
+#
+# Sweeps every (account, governed region) cell of the organization and
+# writes the AWS Config setup of each cell as one JSON record per line to a
+# gzip'd snapshot. Later stages and operators read the snapshot instead of
+# calling AWS again; cells that could not be scanned carry an error. The
+# snapshot is also patched by inventory_updater, so every write is a
+# read-modify-write made conditional on the ETag that was read, and retried
+# on the current snapshot when another writer got there first.
+#
+default_snapshot_key = 'inventory/config_inventory.ndjson.gz'
+snapshot_write_attempts = int(os.environ.get('snapshot_write_attempts', 5))
+snapshot_conflict_codes = [ 'PreconditionFailed', 'ConditionalRequestConflict' ]
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+session = boto3.Session()
+
+class SnapshotConflict(Exception):
+    pass
+
+def assume_role(org_id, aws_account_number, role_name):
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
+
+def get_ct_regions():
+    return region_discovery.get_ct_regions(session)
+
+def get_accounts(ou_id=None):
+    org_client = client_pool.get_client(session, 'organizations')
+    if ou_id:
+        return org_index.get_ou_accounts(org_client, ou_id)
+    index = org_index.get_index(org_client)
+    accounts = []
+    for root_id in sorted(index['roots']):
+        accounts.extend(org_index.get_ou_accounts(org_client, root_id))
+    # the management account has no Control Tower execution role
+    return [ account_id for account_id in accounts if account_id != session_cache.get_account_id() ]
+
+def utc_now():
+    return datetime.now(timezone.utc).isoformat()
+
+def get_trail_count(member_session, region):
+    cloudtrail_client = client_pool.get_client(member_session, 'cloudtrail', region_name=region)
+    trail_count = 0
+    paginator = cloudtrail_client.get_paginator('list_trails')
+    for page in paginator.paginate():
+        trail_count += len(page['Trails'])
+    return trail_count
+
+def scan_cell(member_session, account_id, region):
+    config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+    recorders = config_client.describe_configuration_recorders()['ConfigurationRecorders']
+    recorder_status = config_client.describe_configuration_recorder_status()['ConfigurationRecordersStatus']
+    channels = config_client.describe_delivery_channels()['DeliveryChannels']
+    authorizations = []
+    paginator = config_client.get_paginator('describe_aggregation_authorizations')
+    for page in paginator.paginate():
+        authorizations.extend(page['AggregationAuthorizations'])
+    return {
+        'account': account_id,
+        'region': region,
+        'scanned_at': utc_now(),
+        'recorders': [ {
+            'name': recorder['name'],
+            'roleARN': recorder.get('roleARN'),
+            'allSupported': recorder.get('recordingGroup', {}).get('allSupported', False),
+            'includeGlobalResourceTypes': recorder.get('recordingGroup', {}).get('includeGlobalResourceTypes', False)
+        } for recorder in recorders ],
+        'recorder_status': [ {
+            'name': status['name'],
+            'recording': status.get('recording', False),
+            'lastStatus': status.get('lastStatus')
+        } for status in recorder_status ],
+        'delivery_channels': [ {
+            'name': channel['name'],
+            's3BucketName': channel.get('s3BucketName'),
+            's3KeyPrefix': channel.get('s3KeyPrefix'),
+            'snsTopicARN': channel.get('snsTopicARN')
+        } for channel in channels ],
+        'aggregation_authorizations': sorted([ [ auth['AuthorizedAccountId'], auth['AuthorizedAwsRegion'] ] for auth in authorizations ]),
+        'trail_count': get_trail_count(member_session, region),
+        'error': None
+    }
+
+def error_record(account_id, region, error):
+    return {
+        'account': account_id,
+        'region': region,
+        'scanned_at': utc_now(),
+        'error': error
+    }
+
+def scan_fleet(org_id, role_name, accounts, regions, waiter=None):
+    # returns one record per cell, sorted by (account, region)
+    waiter = waiter or deadline_waiter.Waiter()
+    def scan(account_id, region):
+        if waiter.remaining() <= 0:
+            return error_record(account_id, region, 'not scanned before the deadline')
+        member_session = assume_role(org_id, account_id, role_name)
+        return scan_cell(member_session, account_id, region)
+    cells = [ (account_id, region) for account_id in accounts for region in regions ]
+    with concurrency_controller.AimdController('config_inventory', cell_executor.default_cell_workers) as controller:
+        (results, errors) = cell_executor.run_cells(cells, [ scan ], controller=controller)
+    records = [ results[cell][0] for cell in results ]
+    records.extend([ error_record(cell[0], cell[1], str(errors[cell])) for cell in errors ])
+    LOGGER.info(f"Scanned {len(results)} of {len(cells)} Account Regions")
+    return sorted(records, key=lambda record: (record['account'], record['region']))
+
+def write_snapshot(records, path):
+    with gzip.open(path, 'wt', encoding='utf-8') as snapshot:
+        for record in records:
+            snapshot.write(json.dumps(record, separators=(',', ':'), sort_keys=True))
+            snapshot.write('\n')
+    return path
+
+def read_snapshot(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as snapshot:
+        for line in snapshot:
+            if line.strip():
+                yield json.loads(line)
+
+def cell_of(record):
+    return (record['account'], record['region'])
+
+def download_snapshot(s3_client, bucket, key, path):
+    # returns the ETag of the snapshot written to path, None if there is none
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        LOGGER.info(f"No inventory snapshot at s3://{bucket}/{key}, starting empty")
+        if os.path.exists(path):
+            os.remove(path)
+        return None
+    with open(path, 'wb') as snapshot:
+        for chunk in response['Body'].iter_chunks():
+            snapshot.write(chunk)
+    return response['ETag']
+
+def upload_snapshot(s3_client, bucket, key, path, etag):
+    # only replaces the snapshot that was read with etag
+    conditions = { 'IfMatch': etag } if etag else { 'IfNoneMatch': '*' }
+    with open(path, 'rb') as snapshot:
+        try:
+            s3_client.put_object(Bucket=bucket, Key=key, Body=snapshot, **conditions)
+        except ClientError as ce:
+            if ce.response['Error']['Code'] in snapshot_conflict_codes:
+                raise SnapshotConflict(f"s3://{bucket}/{key} changed since ETag {etag}")
+            raise
+
+def update_snapshot(s3_client, bucket, key, path, update):
+    # update(records) -> records to write, or None to leave the snapshot as
+    # it is; update runs again on the current snapshot after a conflict
+    for attempt in range(snapshot_write_attempts):
+        etag = download_snapshot(s3_client, bucket, key, path)
+        records = list(read_snapshot(path)) if etag else []
+        updated = update(records)
+        if updated is None:
+            return None
+        write_snapshot(updated, path)
+        try:
+            upload_snapshot(s3_client, bucket, key, path, etag)
+            return updated
+        except SnapshotConflict as ex:
+            LOGGER.info(f"Snapshot write conflict, attempt {attempt + 1} of {snapshot_write_attempts}: {str(ex)}")
+            time.sleep(random.uniform(0, min(5, 0.2 * 2 ** attempt)))
+    raise SnapshotConflict(f"s3://{bucket}/{key} not written after {snapshot_write_attempts} attempts")
+
+def merge_scan(scan_versions, records):
+    # scan_versions: { cell: version } of the snapshot when the scan started
+    # returns the update of a full scan: scanned cells replace the current
+    # ones with the next version, cells patched while the scan ran stay
+    # stale, cells dropped while it ran are not added back
+    def update(current):
+        merged = { cell_of(record): record for record in current }
+        for record in records:
+            cell = cell_of(record)
+            stored = merged.get(cell)
+            if stored is None and cell in scan_versions:
+                continue
+            version = stored.get('version', 0) if stored else 0
+            scanned = dict(record)
+            scanned['version'] = version + 1
+            scanned['stale'] = version > scan_versions.get(cell, 0)
+            merged[cell] = scanned
+        return [ merged[cell] for cell in sorted(merged) ]
+    return update
+
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    org_id = event['org_id']
+    ou_id = event.get('org_unit_id')
+    assume_role_name = event['assume_role']
+    snapshot_bucket = event['snapshot_bucket']
+    snapshot_key = event.get('snapshot_key', default_snapshot_key)
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
+    path = os.path.join('/tmp', os.path.basename(snapshot_key))
+    s3_client = client_pool.get_client(session, 's3')
+    scan_versions = {}
+    if download_snapshot(s3_client, snapshot_bucket, snapshot_key, path):
+        scan_versions = { cell_of(record): record.get('version', 0) for record in read_snapshot(path) }
+    accounts = get_accounts(ou_id)
+    ct_regions = get_ct_regions()
+    records = scan_fleet(org_id, assume_role_name, accounts, ct_regions, waiter)
+    update_snapshot(s3_client, snapshot_bucket, snapshot_key, path, merge_scan(scan_versions, records))
+    failed_cells = len([ record for record in records if record['error'] ])
+    LOGGER.info(f"Wrote {len(records)} cells to s3://{snapshot_bucket}/{snapshot_key}")
+    return {
+        'statusCode': 200,
+        'body': {
+            'snapshot_bucket': snapshot_bucket,
+            'snapshot_key': snapshot_key,
+            'cells': len(records),
+            'failed_cells': failed_cells
+        }
+    }
@@ -7,15 +7,14 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import readiness
+import deadline_waiter
+import stackset_deployer
+import region_discovery
+import org_index
 
-#
-# These can be parameterized. Using these for now.
-#
-stackInstanceCheckCount=120
-stackInstanceCheckFrequencySeconds=30
-stackSetCheckFrequencySeconds=30
-stackSetCheckCount=120
-stackSetOpCheckFrequencySeconds=30
 ct_config_recorder_name = 'aws-controltower-BaselineConfigRecorder'
 org_config_recorder_role_name = 'aws-controltower-ConfigRecorderRole-customer-created'
 org_delivery_channel_name = 'aws-controltower-ConfigDeliveryChannel-customer-created'
@@ -38,84 +37,38 @@ def json_serial(obj):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def decrement_stackset_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount = stackSetCheckCount -1
-    LOGGER.info(f"{stackSetCheckCount} more times to check ..")
-
-def decrement_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = stackInstanceCheckCount - 1
-    LOGGER.info(f"{stackInstanceCheckCount} more times to check ..")
-
-def reset_stackcheck_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount=120
-
-def reset_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = 120
-
 def get_ct_regions(ct_session):
-    cf = ct_session.client('cloudformation')
-    region_set = set()
-    try:
-        # stack instances are outdated
-        stacks = cf.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            LOGGER.info(f"Region: {stack['Region']}")
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.warning(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return region_discovery.get_ct_regions(ct_session)
 
 def get_ou(account_id):
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
-    list_parents_response = org_client.list_parents(ChildId=account_id)
-    parent_id = list_parents_response['Parents'][0]['Id']
-    parent_type = list_parents_response['Parents'][0]['Type']
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
+    (parent_id, parent_type) = org_index.get_parent(org_client, account_id)
     if parent_type != 'ROOT':
         return parent_id
     return None
 
 def is_valid_ou(ou_id):
     valid_ou = False
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
     try:
-        root_response = org_client.list_roots()
-        if root_response['Roots']:
-            root_id = root_response['Roots'][0]['Id']
-            LOGGER.info(f"List Organizational Units for Root {root_id} ..")
-            paginator = org_client.get_paginator('list_children')
-            iterator = paginator.paginate(ParentId=root_id, ChildType='ORGANIZATIONAL_UNIT')
-            for page in iterator:
-                for ou in page['Children']:
-                    if ou['Id'] == ou_id:
-                        valid_ou = True
-                        break
+        valid_ou = org_index.ou_exists(org_client, ou_id)
     except Exception as ex:
-        LOGGER.error(f"Error in call org_client.list_children(..)")
+        LOGGER.error(f"Error in building Organization index")
+        LOGGER.error(str(ex))
     return valid_ou
 
 def get_ou_accounts(ou_id):
     accounts = []
-    org_client = session.client('organizations', region_name=os.environ['ct_home_region'])
+    org_client = client_pool.get_client(session, 'organizations', region_name=os.environ['ct_home_region'])
     try:
-        response = org_client.list_accounts_for_parent(ParentId=ou_id)
-        for account in response['Accounts']:
-            if account['Id']:
-                accounts.append(account['Id'])
+        accounts = org_index.get_ou_accounts(org_client, ou_id)
     except Exception as ex:
-        LOGGER.error(f"Error in call list_accounts_for_parent(..) for Organizational Unit {ou_id}")
+        LOGGER.error(f"Error in listing accounts for Organizational Unit {ou_id}")
+        LOGGER.error(str(ex))
     return accounts
 
 def wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-    global stackInstanceCheckCount
-    time.sleep(stackInstanceCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_instance(
             StackSetName=stackSetName,
@@ -134,7 +87,7 @@ def wait_for_stackinstance(ct_session, accountId, region, stackSetName):
 
 
 def create_cf_admin_role(ct_session, s3bucket):
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     stackName = 'AWSCloudFormationStackSetAdministrationRole'
     template_url = 'https://s3.amazonaws.com/'+s3bucket+'/'+stackName+'.yml'
     try:
@@ -151,8 +104,9 @@ def create_cf_admin_role(ct_session, s3bucket):
 
 # ToDo create cf exec role in member account
 
-def create_ct_exec_role(ct_session, accountId, region):
-    cf_client = ct_session.client('cloudformation')
+def create_ct_exec_role(ct_session, accountId, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     stackSetName = 'AWSControlTowerExecutionRole'
     try:
         # get stackset
@@ -165,6 +119,7 @@ def create_ct_exec_role(ct_session, accountId, region):
             StackSetName=stackSetName,
             DeploymentTargets=targets,
             Regions=[region],
+            OperationPreferences=stackset_deployer.operation_preferences(),
             CallAs='SELF'
         )
         LOGGER.info(f"Stack Instance launched for StackSet {stackSetName} with OperationId: {response['OperationId']}")
@@ -172,14 +127,12 @@ def create_ct_exec_role(ct_session, accountId, region):
         LOGGER.error(f"Create Stack Instance for StackSet {stackSetName} failed !")
         LOGGER.error(str(ex))
     # check stack instance is availabe
-    while stackInstanceCheckCount > 0:
-        if wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-            LOGGER.info(f"Stack Instance for StackSet {stackSetName} found in Account {accountId} in Region {region}")
-            break
-        decrement_stackinstance_check_count()
+    if waiter.wait(lambda: wait_for_stackinstance(ct_session, accountId, region, stackSetName), f"StackSet {stackSetName} instance in Account {accountId} in Region {region}"):
+        LOGGER.info(f"Stack Instance for StackSet {stackSetName} found in Account {accountId} in Region {region}")
 
-def create_configrecorder_stack_instance(ct_session, ou_id, region):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_stack_instance(ct_session, ou_id, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     instance_count = 0
     try:
         #response = cf_client.list_stack_instances(StackSetName=kyndryConfigRecorderRoleStackSetName)
@@ -196,9 +149,7 @@ def create_configrecorder_stack_instance(ct_session, ou_id, region):
         #    'RegionConcurrencyType': 'PARALLEL',
         #    'FailureToleranceCount': instance_count
         #}
-        op_prefs = {
-            'RegionConcurrencyType': 'PARALLEL'
-        }
+        op_prefs = stackset_deployer.operation_preferences()
         launch_response = cf_client.create_stack_instances(
             StackSetName=kyndryConfigRecorderRoleStackSetName,
             DeploymentTargets=targets,
@@ -206,22 +157,17 @@ def create_configrecorder_stack_instance(ct_session, ou_id, region):
             OperationPreferences=op_prefs
         )
         LOGGER.info(f"StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} launched with Operation Id: {launch_response['OperationId']}")        
-        while True:
-            operation_status = wait_on_stackset_operation(ct_session, launch_response['OperationId'])
-            if operation_status == 'FAILED' or operation_status == 'STOPPED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
-                raise SystemExit()
-            elif operation_status == 'SUCCEEDED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
-                break
+        operation_status = waiter.wait(lambda: stackset_operation_completed(ct_session, launch_response['OperationId']), f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation {launch_response['OperationId']}")
+        if operation_status != 'SUCCEEDED':
+            LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
+            raise SystemExit()
+        LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
     except Exception as ex:
         LOGGER.error(f"Launch of StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
 
 def wait_for_stackset(ct_session):
-    global stackSetCheckCount
-    time.sleep(stackSetCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_set(StackSetName=kyndryConfigRecorderRoleStackSetName)
         if response['StackSet']:
@@ -233,7 +179,7 @@ def wait_for_stackset(ct_session):
     return False
 
 def wait_on_stackset_operation(ct_session, operationId):
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     op_status = ''
     try:
         stackset_op_response = cf_client.describe_stack_set_operation(StackSetName=kyndryConfigRecorderRoleStackSetName,
@@ -242,14 +188,19 @@ def wait_on_stackset_operation(ct_session, operationId):
         op_status = stackset_op_response['StackSetOperation']['Status']
         if op_status == 'RUNNING':
             LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation with Id {operationId} is Running")
-            time.sleep(stackSetOpCheckFrequencySeconds)
     except Exception as ex:
         LOGGER.info(f"Error waiting on StackSet {kyndryConfigRecorderRoleStackSetName} Operation Id: {operationId}")
         LOGGER.error(str(ex))
     return op_status
 
+def stackset_operation_completed(ct_session, operationId):
+    op_status = wait_on_stackset_operation(ct_session, operationId)
+    if op_status in ('SUCCEEDED', 'FAILED', 'STOPPED'):
+        return op_status
+    return None
+
 def configrecorder_stackset_exists(ct_session, master_account_id):
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_set(StackSetName=kyndryConfigRecorderRoleStackSetName)
         if response['StackSet'] and response['StackSet']['Status'] == 'ACTIVE':
@@ -259,8 +210,9 @@ def configrecorder_stackset_exists(ct_session, master_account_id):
         LOGGER.error(str(ex))
     return False
 
-def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3key):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3key, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     templateUrl = 'https://s3.amazonaws.com/'+s3bucket+'/'+s3key
     adminRoleArn = 'arn:aws:iam::{}:role/AWSCloudFormationStackSetAdministrationRole'.format(master_account_id)
     execRoleName = 'AWSCloudFormationStackSetExecutionRole'
@@ -291,13 +243,11 @@ def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3ke
         LOGGER.error(f"Create StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
     # check StackSet status
-    while stackSetCheckCount > 0:
-        if wait_for_stackset(ct_session):
-            break
-        decrement_stackset_check_count()
+    waiter.wait(lambda: wait_for_stackset(ct_session), f"StackSet {kyndryConfigRecorderRoleStackSetName}")
 
-def create_configrecorder_role(ct_session, ou_id, accountId, region):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_role(ct_session, ou_id, accountId, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     LOGGER.info(f"Launching StackInstances for StackSet {kyndryConfigRecorderRoleStackSetName} ..")
     try:
         LOGGER.info(f"Launching StackSet {kyndryConfigRecorderRoleStackSetName} for Organizational Unit: {ou_id} in Region {region} ..")
@@ -309,9 +259,7 @@ def create_configrecorder_role(ct_session, ou_id, accountId, region):
         #    'RegionConcurrencyType': 'PARALLEL',
         #    'MaxConcurrentCount': len(accounts)
         #}
-        op_prefs = {
-            'RegionConcurrencyType': 'PARALLEL'
-        }
+        op_prefs = stackset_deployer.operation_preferences()
         launch_response = cf_client.create_stack_instances(
             StackSetName=kyndryConfigRecorderRoleStackSetName,
             DeploymentTargets=targets,
@@ -324,60 +272,20 @@ def create_configrecorder_role(ct_session, ou_id, accountId, region):
         #    Regions=[ region ]
         #)
         LOGGER.info(f"StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} launched with Operation Id: {launch_response['OperationId']}")        
-        while True:
-            operation_status = wait_on_stackset_operation(ct_session, launch_response['OperationId'])
-            if operation_status == 'FAILED' or operation_status == 'STOPPED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
-                raise SystemExit()
-            elif operation_status == 'SUCCEEDED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
-                break
+        operation_status = waiter.wait(lambda: stackset_operation_completed(ct_session, launch_response['OperationId']), f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation {launch_response['OperationId']}")
+        if operation_status != 'SUCCEEDED':
+            LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
+            raise SystemExit()
+        LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
     except Exception as ex:
         LOGGER.error(f"Launch of StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
 
 def assume_role(aws_account_number, role_name):
-    #sts_client = boto3.client('sts', region_name=os.environ['AWS_REGION'],
-    #    endpoint_url=f"https://sts.{os.environ['AWS_REGION']}.amazonaws.com")
-    #partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    #current_account = sts_client.get_caller_identity()['Arn'].split(":")[4]
-    #if aws_account_number == current_account:
-    #    LOGGER.info(f"Using existing region_session for Account {aws_account_number}")
-    #    return session
-    #else:
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=os.environ['org_id']
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
-
-def get_ct_regions(ct_session):
-    cf_client = ct_session.client('cloudformation')
-    region_set = set()
-    try:
-        stacks = cf_client.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.error(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return session_cache.get_member_session(os.environ['org_id'], aws_account_number, role_name)
 
 def wait_on_stack(ct_session, accountId, region):
-    cf_client = ct_session.client('cloudformation', endpoint_url=f"https://cloudformation.{region}.amazonaws.com", region_name=region)
+    cf_client = client_pool.get_client(ct_session, 'cloudformation', endpoint_url=f"https://cloudformation.{region}.amazonaws.com", region_name=region)
     stackId = ''
     try:
         list_response = cf_client.list_stack_instances(
@@ -397,7 +305,7 @@ def update_member_recorder(accountId, ct_regions):
     roleArn = 'arn:aws:iam::{}:role/{}'.format(accountId, org_config_recorder_role_name)
     member_session = assume_role(accountId, os.environ['assume_role'])
     for region in ct_regions:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         recorders_response = config_client.describe_configuration_recorders()
         if len(recorders_response['ConfigurationRecorders']) > 0:
             # update 1st recorder
@@ -447,22 +355,30 @@ def start_member_config_recorder(config_client, accountId, region):
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
     ou_id = os.environ['org_unit_id']
     ct_regions = get_ct_regions(session)
     ct_region = os.environ['ct_home_region']
     s3bucket = os.environ['S3Bucket']
     s3key = os.environ['S3Key']
-    master_account_id = boto3.client('sts').get_caller_identity()['Account']
+    master_account_id = session_cache.get_account_id()
     account_id = os.environ['member_account']
     if not is_valid_ou(ou_id):
         LOGGER.error(f"Invalid Organizational Unit {ou_id}. Exiting now.")
         raise SystemExit()
-    # one account at a time
-    create_ct_exec_role(session, account_id, ct_region)
-    reset_stackinstance_check_count()
-    if not configrecorder_stackset_exists(session, master_account_id):
-        create_configrecorder_stackset(session, master_account_id, s3bucket, s3key)
-        create_configrecorder_role(session, ou_id, account_id, ct_region)
+    if readiness.is_readiness_check(event):
+        # probed before any side effect, so a retry of the task only probes
+        # again; the roles are deployed by an earlier deploy_roles task
+        member_session = readiness.probe_role_assumable(os.environ['org_id'], account_id, os.environ['assume_role'])
+        readiness.probe_role_exists(member_session, account_id, org_config_recorder_role_name)
     else:
-        create_configrecorder_stack_instance(session, ou_id, ct_region)
+        # one account at a time
+        create_ct_exec_role(session, account_id, ct_region, waiter)
+        if not configrecorder_stackset_exists(session, master_account_id):
+            create_configrecorder_stackset(session, master_account_id, s3bucket, s3key, waiter)
+            create_configrecorder_role(session, ou_id, account_id, ct_region, waiter)
+        else:
+            create_configrecorder_stack_instance(session, ou_id, ct_region, waiter)
+        if event.get('deploy_roles'):
+            return
     update_member_recorder(account_id, ct_regions)
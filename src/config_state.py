@@ -0,0 +1,133 @@
+import logging
+
+#
+# Desired-state reconciliation of AWS Config resources. The current recorder
+# or delivery channel is described, normalized and compared with the target
+# document; put_*(..) is only called when they differ, so a converged
+# account region costs one describe call and no writes.
+#
+NOOP = 'noop'
+CREATED = 'created'
+UPDATED = 'updated'
+
+default_delivery_frequency = 'TwentyFour_Hours'
+default_recording_frequency = 'CONTINUOUS'
+
+LOGGER = logging.getLogger()
+
+def recorder_document(name, role_arn):
+    return {
+        'name': name,
+        'roleARN': role_arn,
+        'recordingGroup': {
+            'allSupported': True,
+            'includeGlobalResourceTypes': True,
+            'recordingStrategy': {
+                'useOnly': 'ALL_SUPPORTED_RESOURCE_TYPES'
+            }
+        },
+        'recordingMode': {
+            'recordingFrequency': default_recording_frequency
+        }
+    }
+
+def channel_document(name, s3_bucket_name, s3_key_prefix, sns_topic_arn):
+    return {
+        'name': name,
+        's3BucketName': s3_bucket_name,
+        's3KeyPrefix': s3_key_prefix,
+        'snsTopicARN': sns_topic_arn,
+        'configSnapshotDeliveryProperties': {
+            'deliveryFrequency': default_delivery_frequency
+        }
+    }
+
+def default_recording_strategy(recording_group):
+    # the strategy Config applies when a recorder was put without one
+    if recording_group.get('allSupported', False):
+        return 'ALL_SUPPORTED_RESOURCE_TYPES'
+    if recording_group.get('exclusionByResourceTypes', {}).get('resourceTypes'):
+        return 'EXCLUSION_BY_RESOURCE_TYPES'
+    return 'INCLUSION_BY_RESOURCE_TYPES'
+
+def normalize_recording_mode(recording_mode):
+    return {
+        'recordingFrequency': recording_mode.get('recordingFrequency', default_recording_frequency),
+        'recordingModeOverrides': sorted([ [
+            override.get('recordingFrequency'),
+            sorted(override.get('resourceTypes', []))
+        ] for override in recording_mode.get('recordingModeOverrides', []) ])
+    }
+
+def normalize_recorder(recorder):
+    recording_group = recorder.get('recordingGroup', {})
+    return {
+        'name': recorder.get('name'),
+        'roleARN': recorder.get('roleARN'),
+        'allSupported': recording_group.get('allSupported', False),
+        'includeGlobalResourceTypes': recording_group.get('includeGlobalResourceTypes', False),
+        'resourceTypes': sorted(recording_group.get('resourceTypes', [])),
+        'exclusionByResourceTypes': sorted(recording_group.get('exclusionByResourceTypes', {}).get('resourceTypes', [])),
+        'recordingStrategy': recording_group.get('recordingStrategy', {}).get('useOnly') or default_recording_strategy(recording_group),
+        'recordingMode': normalize_recording_mode(recorder.get('recordingMode') or {})
+    }
+
+def normalize_channel(channel):
+    delivery_properties = channel.get('configSnapshotDeliveryProperties', {})
+    return {
+        'name': channel.get('name'),
+        's3BucketName': channel.get('s3BucketName'),
+        's3KeyPrefix': channel.get('s3KeyPrefix') or None,
+        'snsTopicARN': channel.get('snsTopicARN'),
+        'deliveryFrequency': delivery_properties.get('deliveryFrequency', default_delivery_frequency)
+    }
+
+def recording_group_matches(current, target):
+    current = normalize_recorder(current)
+    target = normalize_recorder(target)
+    for key in ('allSupported', 'includeGlobalResourceTypes', 'resourceTypes', 'exclusionByResourceTypes', 'recordingStrategy', 'recordingMode'):
+        if current[key] != target[key]:
+            return False
+    return True
+
+def diff(current, target):
+    # returns { key: (current value, target value) } of all differing keys
+    changes = {}
+    for key in sorted(set(current) | set(target)):
+        if current.get(key) != target.get(key):
+            changes[key] = (current.get(key), target.get(key))
+    return changes
+
+def reconcile_recorder(config_client, target, converged=None):
+    # an existing recorder keeps its name, Config allows one per region;
+    # converged(current) may accept a recorder the plain diff would rewrite
+    recorders = config_client.describe_configuration_recorders()['ConfigurationRecorders']
+    if not recorders:
+        config_client.put_configuration_recorder(ConfigurationRecorder=target)
+        return CREATED
+    current = recorders[0]
+    target = dict(target, name=current['name'])
+    if converged is not None and converged(current):
+        return NOOP
+    changes = diff(normalize_recorder(current), normalize_recorder(target))
+    if not changes:
+        return NOOP
+    LOGGER.info(f"Configuration Recorder {current['name']} differs in: {changes}")
+    config_client.put_configuration_recorder(ConfigurationRecorder=target)
+    return UPDATED
+
+def reconcile_channel(config_client, target, converged=None):
+    channels = config_client.describe_delivery_channels()['DeliveryChannels']
+    if not channels:
+        config_client.put_delivery_channel(DeliveryChannel=target)
+        return CREATED
+    current = channels[0]
+    target = dict(target, name=current['name'])
+    if converged is not None and converged(current):
+        return NOOP
+    changes = diff(normalize_channel(current), normalize_channel(target))
+    if not changes:
+        return NOOP
+    LOGGER.info(f"Delivery Channel {current['name']} differs in: {changes}")
+    config_client.put_delivery_channel(DeliveryChannel=target)
+    return UPDATED
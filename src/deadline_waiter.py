@@ -0,0 +1,49 @@
+import time
+import random
+import logging
+
+#
+# Polls a check function with exponential backoff and full jitter until it
+# returns a truthy value or an absolute deadline passes. The first check
+# runs immediately. A Waiter keeps no per-wait state, so one instance can be
+# shared by threads waiting on different resources at the same time.
+#
+default_wait_seconds = 3600
+deadline_reserve_seconds = 30
+
+LOGGER = logging.getLogger()
+
+def deadline_from_context(context, reserve_seconds=deadline_reserve_seconds):
+    # leave reserve_seconds of the Lambda budget for the rest of the handler
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return time.time() + default_wait_seconds
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - reserve_seconds
+
+class Waiter:
+    def __init__(self, deadline=None, initial_delay=2, max_delay=30, backoff_rate=2):
+        if deadline is None:
+            deadline = time.time() + default_wait_seconds
+        self.deadline = deadline
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_rate = backoff_rate
+
+    def remaining(self):
+        return self.deadline - time.time()
+
+    def wait(self, check, description='resource'):
+        # returns the first truthy result of check(), or None at the deadline
+        attempt = 0
+        while True:
+            result = check()
+            if result:
+                return result
+            remaining = self.remaining()
+            if remaining <= 0:
+                LOGGER.error(f"Deadline reached after {attempt + 1} checks waiting on {description}")
+                return None
+            delay = min(self.max_delay, self.initial_delay * (self.backoff_rate ** attempt))
+            delay = random.uniform(0, delay)
+            attempt += 1
+            LOGGER.info(f"Waiting {delay:.1f}s before check {attempt + 1} on {description} ..")
+            time.sleep(min(delay, remaining))
@@ -8,6 +8,11 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import region_discovery
+import region_fanout
+import concurrency_controller
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -27,43 +32,29 @@ class DeleteFailedException(Exception):
     pass
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
 
 def get_ct_regions():
-    cf = session.client('cloudformation')
-    region_set = set()
+    return region_discovery.get_ct_regions(session)
+
+def stop_config_recorders(member_session, aws_account_number, region):
+    LOGGER.info(f"Stopping Config Recorders for Account: {aws_account_number} in Region: {region} ..")
     try:
-        # stack instances are outdated
-        stacks = cf.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            region_set.add(stack['Region'])
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        response = config_client.describe_configuration_recorders()
+        for recorder in response['ConfigurationRecorders']:
+            config_client.stop_configuration_recorder(ConfigurationRecorderName=recorder['name'])
+            LOGGER.info(f"Stopped Configuration Recorder: {recorder['name']}")
     except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.warning(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+        LOGGER.error(f"Failed in stop_configuration_recorder(..) for Account: {aws_account_number} in Region: {region}")
+        LOGGER.error(str(ex))
+        raise DeleteFailedException('Failed to stop configuration recorders for Account: {} in Region: {}'.format(aws_account_number, region))
 
 def delete_config_recorders(member_session, aws_account_number, region):
     LOGGER.info(f"Deleting Config Recorders for Account: {aws_account_number} in Region: {region} ..")
     is_successful = False
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_configuration_recorders()
         if response['ConfigurationRecorders']:
             for recorder in response['ConfigurationRecorders']:
@@ -91,7 +82,7 @@ def delete_channels(member_session, aws_account_number, region):
     LOGGER.info(f"Deleting Delivery Channels for Account: {aws_account_number} in Region: {region} ..")
     is_successful = False
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_delivery_channels()
         if response['DeliveryChannels']:
             for channel in response['DeliveryChannels']:
@@ -102,7 +93,7 @@ def delete_channels(member_session, aws_account_number, region):
                     is_successful = True
                 except Exception as ex1:
                     LOGGER.error(f"Failed in delete_delivery_channel(..) for Delivery Channel: {name}" )
-                    LOGGER.error(str(ex))
+                    LOGGER.error(str(ex1))
                     is_successful = False
         else:
             LOGGER.info("No Delivery Channels found")
@@ -119,7 +110,7 @@ def delete_authorizations(member_session, aws_account_number, region):
     LOGGER.info(f"Deleting Aggregation Authorizations for Account: {aws_account_number} in Region: {region} ..")
     is_successful = False
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_aggregation_authorizations()
         if response['AggregationAuthorizations']:
             for auth in response['AggregationAuthorizations']:
@@ -144,6 +135,14 @@ def delete_authorizations(member_session, aws_account_number, region):
     if not is_successful:
         raise DeleteFailedException('Failed to delete aggregation authorizations for Account: {} in Region: {}'.format(aws_account_number, region))
 
+def teardown_region(member_session, aws_account_number, region):
+    # order matters within a region: the channel can only be deleted once
+    # the recorder is stopped
+    stop_config_recorders(member_session, aws_account_number, region)
+    delete_channels(member_session, aws_account_number, region)
+    delete_config_recorders(member_session, aws_account_number, region)
+    delete_authorizations(member_session, aws_account_number, region)
+
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
     account_id = event['member_account_id']
@@ -151,25 +150,16 @@ def lambda_handler(event, context):
     assume_role_name = event['assume_role']
     ct_regions = get_ct_regions()
     member_session = assume_role(org_id, account_id, assume_role_name)
-    for region in ct_regions:
-        try:
-            delete_config_recorders(member_session, account_id, region)
-        except DeleteFailedException as dfe:
-            raise dfe
-    for region in ct_regions:
-        try:
-            delete_channels(member_session, account_id, region)
-        except DeleteFailedException as dfe:
-            raise dfe
-    for region in ct_regions:
-        try:
-            delete_authorizations(member_session, account_id, region)
-        except DeleteFailedException as dfe:
-            raise dfe
+    # regions are independent, so each region starts with its own worker;
+    # the controller backs off while Config throttles
+    with concurrency_controller.AimdController('delete_config_resources', len(ct_regions), initial=len(ct_regions)) as controller:
+        (results, errors) = region_fanout.map_regions_collect(
+            lambda region: teardown_region(member_session, account_id, region),
+            ct_regions, max_workers=len(ct_regions), controller=controller)
+    if errors:
+        report = '; '.join([ '{}: {}'.format(region, str(errors[region])) for region in sorted(errors) ])
+        raise DeleteFailedException('Failed to delete config resources for Account: {} in {} of {} Regions: {}'.format(account_id, len(errors), len(ct_regions), report))
     output = {
         'status': True
     }
     return output
-
-
-
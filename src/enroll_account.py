@@ -1,13 +1,22 @@
 import os
 import sys
 import json
+import hashlib
 import boto3
 import urllib3
 import logging
+import re
+import threading
 from random import randint
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import execution_context
+import deadline_waiter
+import enrollment_scheduler
+import record_tracker
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -20,6 +29,19 @@ session = boto3.Session()
 
 # Control Tower Account Factory Product
 product_id = 'prod-be2kwmlhqyo3o'
+ct_account_search_query = 'type:CONTROL_TOWER_ACCOUNT'
+transit_statuses = [ 'UNDER_CHANGE', 'PLAN_IN_PROGRESS' ]
+enroll_pp_name_pattern = re.compile(r'^Enroll-Account-(\d{12})$')
+search_page_size = 100
+# enroll_account has always answered the S3 fields under these keys
+response_field_names = { 's3_bucket': 's3bucket', 's3_key': 's3key' }
+# product artifacts and OU names rarely change, they are kept across warm
+# invocations; an event with invalidate_cache set drops them
+metadata_ttl_seconds = int(os.environ.get('metadata_ttl_seconds', 86400))
+
+_pp_index = {}
+_metadata_cache = {}
+_metadata_cache_lock = threading.Lock()
 
 class SearchProvisionedProductsFailed(Exception):
     pass
@@ -39,26 +61,30 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
+
+def cached_metadata(key, loader):
+    with _metadata_cache_lock:
+        cached = _metadata_cache.get(key)
+        if cached and time.time() - cached[0] <= metadata_ttl_seconds:
+            return cached[1]
+    value = loader()
+    # empty answers are not cached, the next call asks again
+    if value:
+        with _metadata_cache_lock:
+            _metadata_cache[key] = (time.time(), value)
+    return value
+
+def invalidate_metadata():
+    with _metadata_cache_lock:
+        _metadata_cache.clear()
 
 def get_ou_name(ou_id):
+    return cached_metadata(('ou_name', ou_id), lambda: describe_ou_name(ou_id))
+
+def describe_ou_name(ou_id):
     try:
-        org_client = session.client('organizations')
+        org_client = client_pool.get_client(session, 'organizations')
         response = org_client.describe_organizational_unit(OrganizationalUnitId=ou_id)
         if response['OrganizationalUnit']:
             return response['OrganizationalUnit']['Name']
@@ -70,7 +96,7 @@ def get_ou_name(ou_id):
 
 def get_account(account_id):
     try:
-        org_client = session.client('organizations')
+        org_client = client_pool.get_client(session, 'organizations')
         response = org_client.describe_account(AccountId=account_id)
         if response['Account']:
             account = response['Account']
@@ -90,45 +116,73 @@ def get_account(account_id):
         LOGGER.error(str(ex))
         raise ex
 
-def search_provisioned_products(sc_client):
-    ct_pp_list = []
-    error_list = []
-    transit_list = []
-    pp_list = search_provisioned_products_full_list(sc_client)
-    for pp in pp_list:
-        if pp['Type'] == 'CONTROL_TOWER_ACCOUNT':
-            if pp['Status'] == 'ERROR':
-                error_list.append(pp)
-            elif pp['Status'] == 'UNDER_CHANGE' or pp['Status'] == 'PLAN_IN_PROGRESS':
-                transit_list.append(pp)
-            else:
-                ct_pp_list.append(pp)
-    return (ct_pp_list, error_list, transit_list)
-
-def search_provisioned_products_full_list(sc_client):
-    pp_list = []
+def iter_provisioned_products(sc_client, search_query=None):
+    # streams provisioned products page by page, filtered by Service Catalog
     filters = { 'Key': 'Account', 'Value': 'self' }
-    response = {}
-    try:
-        response = sc_client.search_provisioned_products(AccessLevelFilter=filters)
-        #print(json.dumps(response, default=json_serial))
-        pp_list.extend(response['ProvisionedProducts'])
-    except Exception as ex:
-        LOGGER.error("Failed in search_provisioned_products(..)")
-        LOGGER.error(str(ex))
-        raise SystemExit()
-    while 'NextPageToken' in response:
-        next_token = response['NextPageToken']
+    kwargs = { 'AccessLevelFilter': filters, 'PageSize': search_page_size }
+    if search_query:
+        kwargs['Filters'] = { 'SearchQuery': search_query }
+    while True:
         try:
-            response = sc_client.search_provisioned_products(AccessLevelFilter=filters, PageToken=next_token)
-            pp_list.extend(response['ProvisionedProducts'])
+            response = sc_client.search_provisioned_products(**kwargs)
         except Exception as ex:
             LOGGER.error("Failed in search_provisioned_products(..)")
             LOGGER.error(str(ex))
             raise SearchProvisionedProductsFailed(str(ex))
-    return pp_list
+        for pp in response['ProvisionedProducts']:
+            yield pp
+        if not response.get('NextPageToken'):
+            break
+        kwargs['PageToken'] = response['NextPageToken']
+
+def find_transit_product(sc_client):
+    # stops at the first Control Tower account product under change
+    for status in transit_statuses:
+        for pp in iter_provisioned_products(sc_client, [ ct_account_search_query, f"status:{status}" ]):
+            return pp
+    return None
+
+def pp_account_id(pp):
+    match = enroll_pp_name_pattern.match(pp.get('Name', ''))
+    if match:
+        return match.group(1)
+    if pp.get('PhysicalId', '').isdigit():
+        return pp['PhysicalId']
+    return None
+
+class ProvisionedProductIndex:
+    # account id -> Control Tower account provisioned product, filled from
+    # one filtered stream only as far as the lookups need
+    def __init__(self, sc_client):
+        self.products = iter_provisioned_products(sc_client, [ ct_account_search_query ])
+        self.accounts = {}
+        self.complete = False
+
+    def get(self, account_id):
+        while account_id not in self.accounts and not self.complete:
+            pp = next(self.products, None)
+            if pp is None:
+                self.complete = True
+            elif pp_account_id(pp):
+                self.accounts.setdefault(pp_account_id(pp), pp)
+        return self.accounts.get(account_id)
+
+def get_account_pp_index(sc_client):
+    # built once per invocation
+    if 'accounts' not in _pp_index:
+        _pp_index['accounts'] = ProvisionedProductIndex(sc_client)
+    return _pp_index['accounts']
+
+def log_existing_pp(sc_client, account_id):
+    existing_pp = get_account_pp_index(sc_client).get(account_id)
+    if existing_pp is not None:
+        LOGGER.info(f"Account: {account_id} has Provisioned Product {existing_pp['Name']} in Status {existing_pp['Status']}")
+    return existing_pp
 
 def get_provisioning_artifact_id(sc_client):
+    return cached_metadata(('provisioning_artifact_id', product_id), lambda: describe_provisioning_artifact_id(sc_client))
+
+def describe_provisioning_artifact_id(sc_client):
     try:
         response = sc_client.describe_product_as_admin(Id=product_id)
         if response['ProvisioningArtifactSummaries']:
@@ -154,36 +208,129 @@ def provisioning_params(account_json, managed_ou):
     return params
 
 def create_account_pp(account_json, managed_ou):
+    # returns (status, record id) of the provisioning
     status = False
+    record_id = None
     status_message = ''
-    sc_client = session.client('servicecatalog')
+    sc_client = client_pool.get_client(session, 'servicecatalog')
     account_id = account_json['account_id']
-    # get list of pps and their states
-    (ct_pp_list, error_list, transit_list) = search_provisioned_products(sc_client)
-    if len(transit_list) > 0:
+    # one product under change is enough to block the enrolment
+    transit_pp = find_transit_product(sc_client)
+    if transit_pp is not None:
         status_message = 'Another ServiceCatalog operation is in progress. '
         status_message += 'Allow UNDER_CHANGE or PLAN_IN_PROGRESS provisioned products to complete: \n'
-        status_message += json.dumps(transit_list, indent=1, default=json_serial)
+        status_message += json.dumps(transit_pp, indent=1, default=json_serial)
         raise ServiceCatalogOperationBlocked(status_message)
-    else:
-        try:
-            pp_name = 'Enroll-Account-{}'.format(account_json['account_id'])
-            provisioning_artifact_id = get_provisioning_artifact_id(sc_client)
-            params = provisioning_params(account_json, managed_ou)
-            response = sc_client.provision_product(ProductId=product_id,
-                ProvisioningArtifactId=provisioning_artifact_id,
-                ProvisionedProductName=pp_name,
-                ProvisioningParameters=params,
-                ProvisionToken=str(randint(1000000000000, 9999999999999)))
-            status = True
-        except Exception as ex:
-            LOGGER.error(f"Failed in provision_product(..) for Account: {account_id}")
-            LOGGER.error(str(ex))
-            raise AccountEnrolmentFailed(f"Failed in provision_product(..) for Account: {account_id}")
-    return status
+    log_existing_pp(sc_client, account_id)
+    record_id = provision_account_pp(sc_client, account_json, managed_ou)
+    status = True
+    return (status, record_id)
+
+def provision_account_pp(sc_client, account_json, managed_ou):
+    # returns the Service Catalog record id of the provisioning
+    account_id = account_json['account_id']
+    try:
+        pp_name = 'Enroll-Account-{}'.format(account_id)
+        provisioning_artifact_id = get_provisioning_artifact_id(sc_client)
+        params = provisioning_params(account_json, managed_ou)
+        response = sc_client.provision_product(ProductId=product_id,
+            ProvisioningArtifactId=provisioning_artifact_id,
+            ProvisionedProductName=pp_name,
+            ProvisioningParameters=params,
+            ProvisionToken=str(randint(1000000000000, 9999999999999)))
+        return response['RecordDetail']['RecordId']
+    except Exception as ex:
+        LOGGER.error(f"Failed in provision_product(..) for Account: {account_id}")
+        LOGGER.error(str(ex))
+        raise AccountEnrolmentFailed(f"Failed in provision_product(..) for Account: {account_id}")
+
+def config_enabler_execution_arn(state_machine_arn, execution_name):
+    return state_machine_arn.replace(':stateMachine:', ':execution:') + ':' + execution_name
+
+def start_prepare_account(event, schedule_id, account_id):
+    # starts the Config enabler state machine for one account: CloudTrail
+    # verification, Config modification and role stack instances; returns
+    # the execution arn
+    sfn_client = client_pool.get_client(session, 'stepfunctions')
+    state_machine_arn = os.environ['config_enabler_state_machine_arn']
+    execution_name = f"enroll-{schedule_id}-{account_id}"
+    execution_input = { name: event[name] for name in execution_context.context_fields if name in event }
+    execution_input['member_account'] = account_id
+    try:
+        return sfn_client.start_execution(stateMachineArn=state_machine_arn, name=execution_name, input=json.dumps(execution_input))['executionArn']
+    except sfn_client.exceptions.ExecutionAlreadyExists:
+        # started by an earlier run of the same schedule
+        return config_enabler_execution_arn(state_machine_arn, execution_name)
+
+def prepare_status(execution_arn):
+    # None while the execution runs, else its final status
+    sfn_client = client_pool.get_client(session, 'stepfunctions')
+    status = sfn_client.describe_execution(executionArn=execution_arn)['status']
+    return status if status != 'RUNNING' else None
+
+def schedule_id(event):
+    # stable across retries of the same input, so that a retried first run
+    # finds the preparations it started instead of starting them again;
+    # execution_id is the id of the calling execution, if any
+    source = event.get('execution_id') or json.dumps([ event.get('org_unit_id'), sorted(event['member_accounts']) ])
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:12]
+
+def enroll_accounts(event, context):
+    # resumable batch enrolment; pass the returned schedule back in to continue
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
+    sc_client = client_pool.get_client(session, 'servicecatalog')
+    managed_ou = get_ou_name(event['org_unit_id'])
+    schedule = event.get('enrollment_schedule') or enrollment_scheduler.new_schedule(event['member_accounts'])
+    if 'id' not in schedule:
+        schedule['id'] = schedule_id(event)
+    def provision(account_id):
+        transit_pp = find_transit_product(sc_client)
+        if transit_pp is not None:
+            raise enrollment_scheduler.ProvisioningBlocked(f"Provisioned Product {transit_pp['Name']} is {transit_pp['Status']}")
+        log_existing_pp(sc_client, account_id)
+        return provision_account_pp(sc_client, get_account(account_id), managed_ou)
+    schedule = enrollment_scheduler.run(schedule,
+        lambda account_id: start_prepare_account(event, schedule['id'], account_id),
+        prepare_status,
+        provision,
+        lambda record_id: record_tracker.finished_status(sc_client, record_id),
+        waiter)
+    return {
+        'statusCode': 200,
+        'body': execution_context.respond(event, {
+            'enrollment_schedule': schedule,
+            'enrollment_finished': enrollment_scheduler.is_finished(schedule)
+        }, response_field_names)
+    }
+
+def track_records(event, context):
+    # watches the records of earlier provisionings, e.g. of a batch run
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
+    sc_client = client_pool.get_client(session, 'servicecatalog')
+    records = record_tracker.watch(sc_client, event['record_ids'], waiter)
+    return {
+        'statusCode': 200,
+        'body': execution_context.respond(event, {
+            'records': records,
+            'records_finished': all([ record['finished'] for record in records.values() ])
+        }, response_field_names)
+    }
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    event = execution_context.resolve(event)
+    _pp_index.clear()
+    # a response passed back in, e.g. to continue an enrollment_schedule
+    for (name, response_name) in response_field_names.items():
+        if name not in event and response_name in event:
+            event[name] = event[response_name]
+    if event.get('invalidate_cache'):
+        LOGGER.info("Invalidating cached Service Catalog and Organizations metadata")
+        invalidate_metadata()
+    if 'member_accounts' in event or 'enrollment_schedule' in event:
+        return enroll_accounts(event, context)
+    if 'record_ids' in event:
+        return track_records(event, context)
     org_id = event['org_id']
     ou_id = event['org_unit_id']
     ct_home_region = event['ct_home_region']
@@ -196,20 +343,21 @@ def lambda_handler(event, context):
     role_name = event['assume_role']
     account_json = get_account(account_id)
     managed_ou = get_ou_name(ou_id)
-    status = create_account_pp(account_json, managed_ou)
+    (status, record_id) = create_account_pp(account_json, managed_ou)
+    delta = {
+        'member_account_id': account_id,
+        'member_account_region': account_region,
+        'record_id': record_id,
+        'enrol_account_success': status
+    }
+    if record_id and event.get('wait_for_record'):
+        # report the outcome of the provisioning instead of its submission
+        waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
+        sc_client = client_pool.get_client(session, 'servicecatalog')
+        enrollment = record_tracker.watch(sc_client, [ record_id ], waiter)[record_id]
+        delta['enrollment'] = enrollment
+        delta['enrol_account_success'] = enrollment['succeeded']
     return {
         'statusCode': 200,
-        'body': {
-            'org_id': org_id,
-            'org_unit_id': ou_id,
-            'ct_home_region': ct_home_region,
-            's3bucket': s3bucket,
-            's3key': s3key,
-            'member_account_id': account_id,
-            'logarchive_account': logarchive_account,
-            'audit_account': audit_account,
-            'member_account_region': account_region,
-            'assume_role': role_name,
-            'enrol_account_success': status
-        }
+        'body': execution_context.respond(event, delta, response_field_names)
     }
@@ -0,0 +1,116 @@
+import os
+import time
+import random
+import logging
+from botocore.exceptions import ClientError
+
+#
+# Pipelined account enrolment. Service Catalog provisions one Control Tower
+# account at a time, so provisionings are admitted one by one in the order
+# accounts finish their preparation, while the preparation of all other
+# accounts runs concurrently. Preparations are asynchronous operations
+# (state machine executions): all of them are started first and then polled
+# together from the scheduling loop, no thread is parked per account. The
+# schedule is a plain dict that survives the end of a Lambda invocation:
+#   pending    accounts whose preparation is not started yet
+#   preparing  { account: handle } of started preparations
+#   ready      prepared accounts waiting for Service Catalog
+#   active     { account, record_id } being provisioned, or None
+#   results    { account: { status, .. } } of finished accounts
+#
+schedule_poll_initial_seconds = float(os.environ.get('schedule_poll_initial_seconds', 5))
+schedule_poll_seconds = float(os.environ.get('schedule_poll_seconds', 30))
+
+LOGGER = logging.getLogger()
+
+class ProvisioningBlocked(Exception):
+    pass
+
+def new_schedule(accounts):
+    return {
+        'pending': list(accounts),
+        'preparing': {},
+        'ready': [],
+        'active': None,
+        'results': {}
+    }
+
+def is_finished(schedule):
+    return not (schedule['pending'] or schedule.get('preparing') or schedule['ready'] or schedule['active'])
+
+def run(schedule, start_prepare, prepare_status, provision, record_status, waiter):
+    # start_prepare(account) -> handle, prepare_status(handle) -> None while
+    # running, else the final status, 'SUCCEEDED' when prepared.
+    # provision(account) -> record id, record_status(record id) -> None while
+    # in progress, else a result dict.
+    # provision(..) raises ProvisioningBlocked while another operation runs.
+    # Returns the schedule, unfinished when the waiter deadline is reached.
+    schedule.setdefault('preparing', {})
+    pending = schedule['pending']
+    preparing = schedule['preparing']
+    ready = schedule['ready']
+    results = schedule['results']
+    while pending and waiter.remaining() > 0:
+        account = pending.pop(0)
+        try:
+            preparing[account] = start_prepare(account)
+        except Exception as ex:
+            LOGGER.error(f"Preparation failed to start for Account {account}: {str(ex)}")
+            results[account] = { 'status': 'PREPARE_FAILED', 'error': str(ex) }
+    delay = schedule_poll_initial_seconds
+    while (preparing or ready or schedule['active']) and waiter.remaining() > 0:
+        changed = False
+        for account in sorted(preparing):
+            try:
+                status = prepare_status(preparing[account])
+            except Exception as ex:
+                # polled again in the next round
+                LOGGER.error(f"Preparation status unknown for Account {account}: {str(ex)}")
+                continue
+            if status is None:
+                continue
+            changed = True
+            del preparing[account]
+            if status == 'SUCCEEDED':
+                ready.append(account)
+                LOGGER.info(f"Account {account} prepared, {len(ready)} waiting for provisioning")
+            else:
+                LOGGER.error(f"Preparation of Account {account} ended with status: {status}")
+                results[account] = { 'status': 'PREPARE_FAILED', 'error': f"preparation ended with status: {status}" }
+        active = schedule['active']
+        if active is not None:
+            try:
+                result = record_status(active['record_id'])
+            except ClientError as ce:
+                # polled again in the next round
+                LOGGER.error(f"Record {active['record_id']} status unknown for Account {active['account']}: {str(ce)}")
+                result = None
+            if result is not None:
+                LOGGER.info(f"Provisioning of Account {active['account']} finished: {result.get('status')}")
+                results[active['account']] = result
+                schedule['active'] = None
+                changed = True
+        if schedule['active'] is None and ready:
+            account = ready[0]
+            try:
+                schedule['active'] = { 'account': account, 'record_id': provision(account) }
+                ready.pop(0)
+                changed = True
+                LOGGER.info(f"Provisioning Account {account} with Record {schedule['active']['record_id']}")
+            except ProvisioningBlocked as ex:
+                LOGGER.info(f"Provisioning of Account {account} blocked: {str(ex)}")
+            except Exception as ex:
+                LOGGER.error(f"Provisioning failed for Account {account}: {str(ex)}")
+                ready.pop(0)
+                results[account] = { 'status': 'PROVISION_FAILED', 'error': str(ex) }
+                # the next ready account is admitted right away
+                continue
+        if not (preparing or ready or schedule['active']):
+            break
+        remaining = waiter.remaining()
+        if remaining <= 0:
+            break
+        # back off while nothing changes, like record_tracker.watch
+        delay = schedule_poll_initial_seconds if changed else min(schedule_poll_seconds, delay * 2)
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+    return schedule
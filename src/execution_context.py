@@ -0,0 +1,152 @@
+import os
+import json
+import logging
+import hashlib
+import threading
+import boto3
+import client_pool
+
+#
+# Execution context passed by reference between state machine tasks. The
+# fields shared by every task of an execution are stored once and tasks
+# exchange a short context_key plus their per-cell fields. Results larger
+# than spill_threshold_bytes are stored as well and replaced by a
+# spilled_key. context_store selects the backend:
+#   s3://bucket/prefix   S3 objects
+#   /some/directory      local files, for tests and replays
+# Without context_store payloads stay inline, as before.
+#
+context_store = os.environ.get('context_store', '')
+spill_threshold_bytes = int(os.environ.get('spill_threshold_bytes', 128 * 1024))
+context_fields = [ 'org_id', 'org_unit_id', 'ct_home_region', 's3_bucket', 's3_key', 'logarchive_account', 'audit_account', 'assume_role', 'fleet_cell' ]
+cell_fields = [ 'member_account', 'member_region' ]
+
+LOGGER = logging.getLogger()
+
+session = boto3.Session()
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+_store = {}
+
+class ContextNotFound(Exception):
+    pass
+
+class S3Store:
+    def __init__(self, bucket, prefix):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def _key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put(self, key, data):
+        s3_client = client_pool.get_client(session, 's3')
+        s3_client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data.encode('utf-8'))
+
+    def get(self, key):
+        s3_client = client_pool.get_client(session, 's3')
+        try:
+            response = s3_client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except s3_client.exceptions.NoSuchKey:
+            raise ContextNotFound(f"s3://{self.bucket}/{self._key(key)}")
+        return response['Body'].read().decode('utf-8')
+
+class LocalStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def put(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key), 'w') as context_file:
+            context_file.write(data)
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            raise ContextNotFound(path)
+        with open(path) as context_file:
+            return context_file.read()
+
+def get_store():
+    if not context_store:
+        return None
+    if 'store' not in _store:
+        if context_store.startswith('s3://'):
+            (bucket, _, prefix) = context_store[len('s3://'):].partition('/')
+            _store['store'] = S3Store(bucket, prefix)
+        else:
+            _store['store'] = LocalStore(context_store)
+    return _store['store']
+
+def _content_key(kind, data):
+    # equal content maps to the same key, so re-puts are idempotent
+    return f"{kind}-{hashlib.sha256(data.encode('utf-8')).hexdigest()[:24]}"
+
+def put_context(fields):
+    data = json.dumps({ name: fields[name] for name in context_fields if name in fields }, sort_keys=True, separators=(',', ':'))
+    key = _content_key('context', data)
+    with _contexts_lock:
+        if key in _contexts:
+            return key
+    get_store().put(key, data)
+    with _contexts_lock:
+        _contexts[key] = json.loads(data)
+    return key
+
+def get_context(key):
+    with _contexts_lock:
+        if key in _contexts:
+            return _contexts[key]
+    fields = json.loads(get_store().get(key))
+    with _contexts_lock:
+        _contexts[key] = fields
+    return fields
+
+def share(event):
+    # returns the event with a context_key once the shared fields are stored
+    store = get_store()
+    if store is None or 'context_key' in event:
+        return event
+    shared = dict(event)
+    shared['context_key'] = put_context(event)
+    return shared
+
+def resolve(event):
+    # returns the full event of a task input that may carry references
+    event = dict(event)
+    if 'spilled_key' in event:
+        event.update(json.loads(get_store().get(event.pop('spilled_key'))))
+    if 'context_key' in event:
+        for (name, value) in get_context(event['context_key']).items():
+            event.setdefault(name, value)
+    return event
+
+def spill(body):
+    store = get_store()
+    if store is None:
+        return body
+    data = json.dumps(body, default=str, sort_keys=True, separators=(',', ':'))
+    if len(data) <= spill_threshold_bytes:
+        return body
+    key = _content_key('result', data)
+    store.put(key, data)
+    LOGGER.info(f"Spilled {len(data)} bytes of result to {key}")
+    # scalar fields stay inline for Choice states
+    spilled = { name: value for (name, value) in body.items() if isinstance(value, (bool, int, float)) }
+    spilled['spilled_key'] = key
+    return spilled
+
+def respond(event, delta, field_names=None):
+    # task result: context reference and cell fields, or all fields inline;
+    # field_names renames inline fields for handlers answering other keys
+    field_names = field_names or {}
+    if 'context_key' in event:
+        body = { 'context_key': event['context_key'] }
+    else:
+        body = { field_names.get(name, name): event[name] for name in context_fields if name in event }
+    for name in cell_fields:
+        if name in event:
+            body[name] = event[name]
+    body.update(delta)
+    return spill(body)
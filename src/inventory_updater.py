@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import boto3
+import logging
+from datetime import datetime, timezone
+import session_cache
+import client_pool
+import region_discovery
+import org_index
+import config_inventory
+
+#
+# Keeps a Config inventory snapshot current without full rescans. AWS Config
+# notifications from aws-controltower-AllConfigNotifications arrive in SQS
+# batches and, like Organizations account events, only patch the (account,
+# region) cells they name. A batch patches each named cell once: the cell
+# version is bumped and the cell is marked stale, and the snapshot is
+# rewritten once per batch. The full scan writes the snapshot as well, so
+# the rewrite is conditional on the ETag that was read and the batch is
+# applied again to the current snapshot on a conflict. Stale cells, and
+# cells older than inventory_max_age_seconds, are rescanned when they are
+# read. Events never call AWS, so recorded payloads can be replayed offline
+# against a local snapshot:
+#   python inventory_updater.py snapshot.ndjson.gz event1.json [event2.json ..]
+#
+inventory_max_age_seconds = int(os.environ.get('inventory_max_age_seconds', 86400))
+# Organizations events recorded in the management account; Organizations
+# delivers them to EventBridge in us-east-1 only
+account_events = [ 'CreateAccountResult', 'MoveAccount', 'RemoveAccountFromOrganization' ]
+
+LOGGER = logging.getLogger()
+if 'log_level' in os.environ:
+    LOGGER.setLevel(os.environ['log_level'])
+    LOGGER.info('Log level set to %s' % LOGGER.getEffectiveLevel())
+else:
+    LOGGER.setLevel(logging.ERROR)
+
+session = boto3.Session()
+
+def load_inventory(path):
+    inventory = {}
+    if os.path.exists(path):
+        for record in config_inventory.read_snapshot(path):
+            inventory[(record['account'], record['region'])] = record
+    return inventory
+
+def save_inventory(inventory, path):
+    return config_inventory.write_snapshot([ inventory[cell] for cell in sorted(inventory) ], path)
+
+def mark_stale(inventory, account_id, region, reason):
+    record = inventory.get((account_id, region))
+    if record is None:
+        record = config_inventory.error_record(account_id, region, None)
+        inventory[(account_id, region)] = record
+    record['version'] = record.get('version', 0) + 1
+    record['stale'] = True
+    record['last_event'] = reason
+    return (account_id, region)
+
+def drop_account(inventory, account_id):
+    cells = [ cell for cell in inventory if cell[0] == account_id ]
+    for cell in cells:
+        del inventory[cell]
+    return cells
+
+def account_regions(inventory, account_id):
+    return sorted(set([ cell[1] for cell in inventory if cell[0] == account_id ]))
+
+def notification_cell(message):
+    # every Config notification names the account and region it comes from
+    item = message.get('configurationItem') or message.get('configurationItemSummary') or {}
+    account_id = message.get('awsAccountId') or item.get('awsAccountId')
+    region = message.get('awsRegion') or item.get('awsRegion')
+    if not account_id or not region:
+        LOGGER.info(f"Ignoring Config notification without account and region: {message.get('messageType')}")
+        return None
+    return (account_id, region)
+
+def notification_message(record):
+    # SNS records, or SQS records with the SNS envelope unless raw message
+    # delivery is enabled on the subscription
+    if 'Sns' in record:
+        return json.loads(record['Sns']['Message'])
+    if record.get('eventSource') == 'aws:sqs':
+        body = json.loads(record['body'])
+        if body.get('Type') == 'Notification' and 'Message' in body:
+            return json.loads(body['Message'])
+        return body
+    return None
+
+def apply_config_notifications(inventory, records):
+    # a batch patches every notified cell once, however many notifications name it
+    reasons = {}
+    for record in records:
+        try:
+            message = notification_message(record)
+        except ValueError as ex:
+            LOGGER.error(f"Ignoring unreadable notification {record.get('messageId')}: {str(ex)}")
+            continue
+        if message is None:
+            continue
+        cell = notification_cell(message)
+        if cell is not None:
+            reasons[cell] = message.get('messageType', 'ConfigNotification')
+    LOGGER.info(f"Coalesced {len(records)} notifications into {len(reasons)} cells")
+    return [ mark_stale(inventory, cell[0], cell[1], reasons[cell]) for cell in sorted(reasons) ]
+
+def apply_organizations_event(inventory, detail, regions):
+    event_name = detail.get('eventName')
+    parameters = detail.get('requestParameters') or {}
+    if event_name not in account_events:
+        return []
+    org_index.invalidate()
+    if event_name == 'CreateAccountResult':
+        status = (detail.get('serviceEventDetails') or {}).get('createAccountStatus') or {}
+        if status.get('state') != 'SUCCEEDED' or not status.get('accountId'):
+            return []
+        return [ mark_stale(inventory, status['accountId'], region, event_name) for region in regions ]
+    account_id = parameters.get('accountId')
+    if not account_id:
+        return []
+    if event_name == 'MoveAccount':
+        return [ mark_stale(inventory, account_id, region, event_name) for region in account_regions(inventory, account_id) or regions ]
+    return drop_account(inventory, account_id)
+
+def apply_event(inventory, event, regions):
+    # returns the patched cells of an SQS batch or an EventBridge event
+    patched = apply_config_notifications(inventory, event.get('Records', []))
+    if event.get('source') == 'aws.organizations':
+        patched.extend(apply_organizations_event(inventory, event.get('detail') or {}, regions))
+    return patched
+
+def is_stale(record):
+    if record.get('stale') or record.get('error'):
+        return True
+    scanned_at = datetime.fromisoformat(record['scanned_at'])
+    return (datetime.now(timezone.utc) - scanned_at).total_seconds() > inventory_max_age_seconds
+
+def rescan_cell(org_id, role_name):
+    def rescan(account_id, region):
+        member_session = session_cache.get_member_session(org_id, account_id, role_name)
+        return config_inventory.scan_cell(member_session, account_id, region)
+    return rescan
+
+def get_cell(inventory, account_id, region, rescan):
+    record = inventory.get((account_id, region))
+    if record is not None and not is_stale(record):
+        return record
+    version = record.get('version', 0) if record else 0
+    try:
+        record = rescan(account_id, region)
+    except Exception as ex:
+        LOGGER.error(f"Rescan failed for Account {account_id} in Region {region}")
+        LOGGER.error(str(ex))
+        record = config_inventory.error_record(account_id, region, str(ex))
+    record['version'] = version + 1
+    record['stale'] = False
+    inventory[(account_id, region)] = record
+    return record
+
+def replay(snapshot_path, event_paths, regions=None):
+    inventory = load_inventory(snapshot_path)
+    patched = []
+    for event_path in event_paths:
+        with open(event_path) as event_file:
+            patched.extend(apply_event(inventory, json.load(event_file), regions or []))
+    save_inventory(inventory, snapshot_path)
+    return patched
+
+def lambda_handler(event, context):
+    LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    snapshot_bucket = os.environ['snapshot_bucket']
+    snapshot_key = os.environ.get('snapshot_key', config_inventory.default_snapshot_key)
+    path = os.path.join('/tmp', os.path.basename(snapshot_key))
+    s3_client = client_pool.get_client(session, 's3')
+    body = {}
+    if 'cells' in event:
+        # read request: [ { account, region } ], stale cells are rescanned
+        # once, even when the snapshot write is retried
+        rescan_fresh = rescan_cell(os.environ['org_id'], os.environ['assume_role'])
+        rescanned = {}
+        def rescan(account_id, region):
+            if (account_id, region) not in rescanned:
+                rescanned[(account_id, region)] = rescan_fresh(account_id, region)
+            return dict(rescanned[(account_id, region)])
+    else:
+        regions = region_discovery.get_ct_regions(session)
+    def update(records):
+        inventory = { config_inventory.cell_of(record): record for record in records }
+        if 'cells' in event:
+            body['cells'] = [ get_cell(inventory, cell['account'], cell['region'], rescan) for cell in event['cells'] ]
+            changed = bool(rescanned)
+        else:
+            patched = apply_event(inventory, event, regions)
+            body['patched_cells'] = len(patched)
+            changed = bool(patched)
+        if not changed:
+            return None
+        return [ inventory[cell] for cell in sorted(inventory) ]
+    # one conditional snapshot rewrite per batch of events, the batch is
+    # applied again to the current snapshot when another writer got first
+    config_inventory.update_snapshot(s3_client, snapshot_bucket, snapshot_key, path, update)
+    return {
+        'statusCode': 200,
+        'body': body
+    }
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    patched = replay(sys.argv[1], sys.argv[2:])
+    print(json.dumps({ 'patched_cells': [ list(cell) for cell in patched ] }))
@@ -7,12 +7,14 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import execution_context
+import deadline_waiter
+import stackset_deployer
+import config_state
+import org_index
 
-stackInstanceCheckCount=120
-stackInstanceCheckFrequencySeconds=30
-stackSetCheckFrequencySeconds=30
-stackSetCheckCount=120
-stackSetOpCheckFrequencySeconds=30
 ct_config_recorder_name = 'aws-controltower-BaselineConfigRecorder'
 org_config_recorder_role_name = 'aws-controltower-ConfigRecorderRole-customer-created'
 org_delivery_channel_name = 'aws-controltower-ConfigDeliveryChannel-customer-created'
@@ -36,64 +38,30 @@ class OUMismatchException(Exception):
 class InvalidOUException(Exception):
     pass
 
-class PutConfigRecorderFailed(Exception):
-    pass
-
 def json_serial(obj):
     if isinstance(obj, (datetime, date)):
         return obj.isoformat()
     raise TypeError('Type %s not serializable' % type(obj))
 
-def decrement_stackset_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount = stackSetCheckCount -1
-    LOGGER.info(f"{stackSetCheckCount} more times to check ..")
-
-def decrement_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = stackInstanceCheckCount - 1
-    LOGGER.info(f"{stackInstanceCheckCount} more times to check ..")
-
-def reset_stackcheck_check_count():
-    global stackSetCheckCount
-    stackSetCheckCount=120
-
-def reset_stackinstance_check_count():
-    global stackInstanceCheckCount
-    stackInstanceCheckCount = 120
-
 def is_valid_ou(ou_id, ct_home_region):
     valid_ou = False
-    org_client = session.client('organizations', region_name=ct_home_region)
+    org_client = client_pool.get_client(session, 'organizations', region_name=ct_home_region)
     try:
-        root_response = org_client.list_roots()
-        if root_response['Roots']:
-            root_id = root_response['Roots'][0]['Id']
-            LOGGER.info(f"List Organizational Units for Root {root_id} ..")
-            paginator = org_client.get_paginator('list_children')
-            iterator = paginator.paginate(ParentId=root_id, ChildType='ORGANIZATIONAL_UNIT')
-            for page in iterator:
-                for ou in page['Children']:
-                    if ou['Id'] == ou_id:
-                        valid_ou = True
-                        break
+        valid_ou = org_index.ou_exists(org_client, ou_id)
     except Exception as ex:
-        LOGGER.error(f"Error in call org_client.list_children(..)")
+        LOGGER.error(f"Error in building Organization index")
+        LOGGER.error(str(ex))
     return valid_ou
 
 def get_ou(account_id, ct_home_region):
-    org_client = session.client('organizations', region_name=ct_home_region)
-    list_parents_response = org_client.list_parents(ChildId=account_id)
-    parent_id = list_parents_response['Parents'][0]['Id']
-    parent_type = list_parents_response['Parents'][0]['Type']
+    org_client = client_pool.get_client(session, 'organizations', region_name=ct_home_region)
+    (parent_id, parent_type) = org_index.get_parent(org_client, account_id)
     if parent_type != 'ROOT':
         return parent_id
     return None
 
 def wait_for_stackset(ct_session):
-    global stackSetCheckCount
-    time.sleep(stackSetCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_set(StackSetName=kyndryConfigRecorderRoleStackSetName)
         if response['StackSet']:
@@ -105,7 +73,7 @@ def wait_for_stackset(ct_session):
     return False
 
 def wait_on_stackset_operation(ct_session, operationId):
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     op_status = ''
     try:
         stackset_op_response = cf_client.describe_stack_set_operation(StackSetName=kyndryConfigRecorderRoleStackSetName,
@@ -114,16 +82,19 @@ def wait_on_stackset_operation(ct_session, operationId):
         op_status = stackset_op_response['StackSetOperation']['Status']
         if op_status == 'RUNNING':
             LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation with Id {operationId} is Running")
-            time.sleep(stackSetOpCheckFrequencySeconds)
     except Exception as ex:
         LOGGER.info(f"Error waiting on StackSet {kyndryConfigRecorderRoleStackSetName} Operation Id: {operationId}")
         LOGGER.error(str(ex))
     return op_status
 
+def stackset_operation_completed(ct_session, operationId):
+    op_status = wait_on_stackset_operation(ct_session, operationId)
+    if op_status in ('SUCCEEDED', 'FAILED', 'STOPPED'):
+        return op_status
+    return None
+
 def wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-    global stackInstanceCheckCount
-    time.sleep(stackInstanceCheckFrequencySeconds)
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_instance(
             StackSetName=stackSetName,
@@ -141,7 +112,7 @@ def wait_for_stackinstance(ct_session, accountId, region, stackSetName):
     return False
 
 def wait_on_stack(ct_session, accountId, region):
-    cf_client = ct_session.client('cloudformation', endpoint_url=f"https://cloudformation.{region}.amazonaws.com", region_name=region)
+    cf_client = client_pool.get_client(ct_session, 'cloudformation', endpoint_url=f"https://cloudformation.{region}.amazonaws.com", region_name=region)
     stackId = ''
     try:
         list_response = cf_client.list_stack_instances(
@@ -157,8 +128,9 @@ def wait_on_stack(ct_session, accountId, region):
         LOGGER.error(f"Failed while waiting on {stackId} status=CREATE_COMPLETE for Account {accountId} in Region {region}")
         LOGGER.error(str(ex))
 
-def create_ct_exec_role(ct_session, ou_id, accountId, region):
-    cf_client = ct_session.client('cloudformation')
+def create_ct_exec_role(ct_session, ou_id, accountId, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     stackSetName = 'AWSControlTowerExecutionRole'
     try:
         # get stackset
@@ -174,6 +146,7 @@ def create_ct_exec_role(ct_session, ou_id, accountId, region):
             StackSetName=stackSetName,
             DeploymentTargets=targets,
             Regions=[region],
+            OperationPreferences=stackset_deployer.operation_preferences(),
             CallAs='SELF'
         )
         LOGGER.info(f"Stack Instance launched for StackSet {stackSetName} with OperationId: {response['OperationId']}")
@@ -181,22 +154,18 @@ def create_ct_exec_role(ct_session, ou_id, accountId, region):
         LOGGER.error(f"Create Stack Instance for StackSet {stackSetName} failed !")
         LOGGER.error(str(ex))
     # check stack instance is availabe
-    while stackInstanceCheckCount > 0:
-        if wait_for_stackinstance(ct_session, accountId, region, stackSetName):
-            LOGGER.info(f"Stack Instance for StackSet {stackSetName} found in Account {accountId} in Region {region}")
-            break
-        decrement_stackinstance_check_count()
+    if waiter.wait(lambda: wait_for_stackinstance(ct_session, accountId, region, stackSetName), f"StackSet {stackSetName} instance in Account {accountId} in Region {region}"):
+        LOGGER.info(f"Stack Instance for StackSet {stackSetName} found in Account {accountId} in Region {region}")
 
-def create_configrecorder_stack_instance(ct_session, ou_id, region):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_stack_instance(ct_session, ou_id, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     instance_count = 0
     try:
         targets = {
             'OrganizationalUnitIds': [ ou_id ]
         }
-        op_prefs = {
-            'RegionConcurrencyType': 'PARALLEL'
-        }
+        op_prefs = stackset_deployer.operation_preferences()
         launch_response = cf_client.create_stack_instances(
             StackSetName=kyndryConfigRecorderRoleStackSetName,
             DeploymentTargets=targets,
@@ -204,20 +173,17 @@ def create_configrecorder_stack_instance(ct_session, ou_id, region):
             OperationPreferences=op_prefs
         )
         LOGGER.info(f"StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} launched with Operation Id: {launch_response['OperationId']}")        
-        while True:
-            operation_status = wait_on_stackset_operation(ct_session, launch_response['OperationId'])
-            if operation_status == 'FAILED' or operation_status == 'STOPPED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
-                raise SystemExit()
-            elif operation_status == 'SUCCEEDED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
-                break
+        operation_status = waiter.wait(lambda: stackset_operation_completed(ct_session, launch_response['OperationId']), f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation {launch_response['OperationId']}")
+        if operation_status != 'SUCCEEDED':
+            LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
+            raise SystemExit()
+        LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
     except Exception as ex:
         LOGGER.error(f"Launch of StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
 
 def configrecorder_stackset_exists(ct_session, master_account_id):
-    cf_client = ct_session.client('cloudformation')
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     try:
         response = cf_client.describe_stack_set(StackSetName=kyndryConfigRecorderRoleStackSetName)
         if response['StackSet'] and response['StackSet']['Status'] == 'ACTIVE':
@@ -227,8 +193,9 @@ def configrecorder_stackset_exists(ct_session, master_account_id):
         LOGGER.error(str(ex))
     return False
 
-def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3key):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3key, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     templateUrl = 'https://s3.amazonaws.com/'+s3bucket+'/'+s3key
     adminRoleArn = 'arn:aws:iam::{}:role/AWSCloudFormationStackSetAdministrationRole'.format(master_account_id)
     execRoleName = 'AWSCloudFormationStackSetExecutionRole'
@@ -249,22 +216,18 @@ def create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3ke
         LOGGER.error(f"Create StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
     # check StackSet status
-    while stackSetCheckCount > 0:
-        if wait_for_stackset(ct_session):
-            break
-        decrement_stackset_check_count()
+    waiter.wait(lambda: wait_for_stackset(ct_session), f"StackSet {kyndryConfigRecorderRoleStackSetName}")
 
-def create_configrecorder_role(ct_session, ou_id, accountId, region):
-    cf_client = ct_session.client('cloudformation')
+def create_configrecorder_role(ct_session, ou_id, accountId, region, waiter=None):
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
     LOGGER.info(f"Launching StackInstances for StackSet {kyndryConfigRecorderRoleStackSetName} ..")
     try:
         LOGGER.info(f"Launching StackSet {kyndryConfigRecorderRoleStackSetName} for Organizational Unit: {ou_id} in Region {region} ..")
         targets = {
             'OrganizationalUnitIds': [ ou_id ]
         }
-        op_prefs = {
-            'RegionConcurrencyType': 'PARALLEL'
-        }
+        op_prefs = stackset_deployer.operation_preferences()
         launch_response = cf_client.create_stack_instances(
             StackSetName=kyndryConfigRecorderRoleStackSetName,
             DeploymentTargets=targets,
@@ -272,126 +235,106 @@ def create_configrecorder_role(ct_session, ou_id, accountId, region):
             OperationPreferences=op_prefs
         )
         LOGGER.info(f"StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} launched with Operation Id: {launch_response['OperationId']}")        
-        while True:
-            operation_status = wait_on_stackset_operation(ct_session, launch_response['OperationId'])
-            if operation_status == 'FAILED' or operation_status == 'STOPPED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
-                raise SystemExit()
-            elif operation_status == 'SUCCEEDED':
-                LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
-                break
+        operation_status = waiter.wait(lambda: stackset_operation_completed(ct_session, launch_response['OperationId']), f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation {launch_response['OperationId']}")
+        if operation_status != 'SUCCEEDED':
+            LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation failed. Exiting here !")
+            raise SystemExit()
+        LOGGER.info(f"StackSet {kyndryConfigRecorderRoleStackSetName} Operation successful.")
     except Exception as ex:
         LOGGER.error(f"Launch of StackInstance for StackSet {kyndryConfigRecorderRoleStackSetName} failed !")
         LOGGER.error(str(ex))
 
+def get_manifest_accounts(bucket, key):
+    s3_client = client_pool.get_client(session, 's3')
+    cells = json.loads(s3_client.get_object(Bucket=bucket, Key=key)['Body'].read())
+    return sorted(set([ cell['member_account'] for cell in cells ]))
+
+def deploy_fleet_roles(ct_session, master_account_id, accounts, region, s3bucket, s3key, waiter=None):
+    # runs once before the fleet Map, so that fleet cells do not start
+    # overlapping operations on the same StackSets; the roles are deployed
+    # to the parent OU of every manifest account
+    waiter = waiter or deadline_waiter.Waiter()
+    account_ous = { accountId: get_ou(accountId, region) for accountId in accounts }
+    root_accounts = [ accountId for accountId in accounts if account_ous[accountId] is None ]
+    if root_accounts:
+        raise OUMismatchException(f"Accounts {root_accounts} of the fleet manifest are not in an Organizational Unit")
+    ou_ids = sorted(set(account_ous.values()))
+    if not configrecorder_stackset_exists(ct_session, master_account_id):
+        create_configrecorder_stackset(ct_session, master_account_id, s3bucket, s3key, waiter)
+    targets = []
+    for ou_id in ou_ids:
+        targets.append(('AWSControlTowerExecutionRole', ou_id, region))
+        targets.append((kyndryConfigRecorderRoleStackSetName, ou_id, region))
+    stackset_deployer.deploy(ct_session, stackset_deployer.plan_deployments(targets), waiter)
+    statuses = stackset_deployer.wait_for_instances(ct_session, [ 'AWSControlTowerExecutionRole', kyndryConfigRecorderRoleStackSetName ], accounts, region, waiter)
+    failed = sorted([ key for key in statuses if statuses[key] != 'SUCCEEDED' ])
+    if failed:
+        raise stackset_deployer.StackSetDeploymentFailed(f"StackSet instances not deployed for (StackSet, Account): {failed}")
+    LOGGER.info(f"Roles deployed for {len(accounts)} fleet Accounts in Organizational Units {ou_ids}")
+
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
 
 def update_member_recorder(org_id, accountId, region, role_name):
+    # returns (status, result) with result one of noop / created / updated
     status = False
+    result = None
     roleArn = 'arn:aws:iam::{}:role/{}'.format(accountId, org_config_recorder_role_name)
     member_session = assume_role(org_id, accountId, role_name)
-    config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
-    recorders_response = config_client.describe_configuration_recorders()
-    if len(recorders_response['ConfigurationRecorders']) > 0:
-        # update 1st recorder
-        recorder_name = recorders_response['ConfigurationRecorders'][0]['name']
-        recorder_dict = {
-            'name': recorder_name,
-            'roleARN': roleArn,
-            'recordingGroup': {
-                'allSupported': True,
-                'includeGlobalResourceTypes': True
-            }
-        }
-        try:
-            config_client.put_configuration_recorder(ConfigurationRecorder=recorder_dict)
-            status = True
-        except Exception as ex:
-            LOGGER.error(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
-            LOGGER.error(str(ex))
-            raise PutConfigRecorderFailed(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
-        finally:
-            return status
-    else:
-        # no configuration recorder, so create it
-        LOGGER.info(f"No configuration recorder found for Account {accountId} in Region {region}. Creating it now.")
-        status = create_member_config_recorder(config_client, accountId, region, roleArn)
-    return status
-
-def create_member_config_recorder(config_client, accountId, region, roleArn):
-    status = False
-    recorder_dict = {
-        'name': ct_config_recorder_name,
-        'roleARN': roleArn,
-        'recordingGroup': {
-            'allSupported': True,
-            'includeGlobalResourceTypes': True
-        }
-    }
+    config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+    recorder_dict = config_state.recorder_document(ct_config_recorder_name, roleArn)
     try:
-        config_client.put_configuration_recorder(ConfigurationRecorder=recorder_dict)
+        result = config_state.reconcile_recorder(config_client, recorder_dict)
         status = True
+        LOGGER.info(f"Configuration recorder for Account {accountId} in Region {region}: {result}")
     except Exception as ex:
         LOGGER.error(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
         LOGGER.error(str(ex))
-        raise PutConfigRecorderFailed(f"put_configuration_recorder(..) call failed for Account {accountId} in Region {region}")
-    finally:
-        return status
+    return (status, result)
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    event = execution_context.resolve(event)
+    waiter = deadline_waiter.Waiter(deadline_waiter.deadline_from_context(context))
     org_id = event['org_id']
     ou_id = event['org_unit_id']
     ct_home_region = event['ct_home_region']
     s3bucket = event['s3_bucket']
     s3key = event['s3_key']
-    master_account_id = boto3.client('sts').get_caller_identity()['Account']
-    account_id = event['member_account']
+    master_account_id = session_cache.get_account_id()
+    account_id = event.get('member_account')
     logarchive_account = event['logarchive_account']
     audit_account = event['audit_account']
-    account_region = event['member_region']
+    account_region = event.get('member_region')
     assume_role = event['assume_role']
     if not is_valid_ou(ou_id, ct_home_region):
         LOGGER.error(f"Invalid Organizational Unit {ou_id}. Exiting now.")
         raise InvalidOUException(f"Invalid Organizational Unit {ou_id}. Exiting now.")
-    # one account at a time
-    create_ct_exec_role(session, ou_id, account_id, ct_home_region)
-    reset_stackinstance_check_count()
-    if not configrecorder_stackset_exists(session, master_account_id):
-        create_configrecorder_stackset(session, master_account_id, s3bucket, s3key)
-        create_configrecorder_role(session, ou_id, account_id, ct_home_region)
+    if 'fleet_manifest_key' in event:
+        accounts = get_manifest_accounts(event['fleet_manifest_bucket'], event['fleet_manifest_key'])
+        deploy_fleet_roles(session, master_account_id, accounts, ct_home_region, s3bucket, s3key, waiter)
+        return {
+            'statusCode': 200,
+            'body': {
+                'fleet_roles_accounts': len(accounts)
+            }
+        }
+    if event.get('fleet_cell'):
+        # the roles of all fleet cells were deployed before the fleet Map
+        LOGGER.info(f"Fleet cell of Account {account_id}, skipping role StackSets")
     else:
-        create_configrecorder_stack_instance(session, ou_id, ct_home_region)
-    status = update_member_recorder(org_id, account_id, account_region, assume_role)
+        # one account at a time
+        create_ct_exec_role(session, ou_id, account_id, ct_home_region, waiter)
+        if not configrecorder_stackset_exists(session, master_account_id):
+            create_configrecorder_stackset(session, master_account_id, s3bucket, s3key, waiter)
+            create_configrecorder_role(session, ou_id, account_id, ct_home_region, waiter)
+        else:
+            create_configrecorder_stack_instance(session, ou_id, ct_home_region, waiter)
+    (status, result) = update_member_recorder(org_id, account_id, account_region, assume_role)
     return {
         'statusCode': 200,
-        'body': {
-            'org_id': org_id,
-            'org_unit_id': ou_id,
-            'ct_home_region': ct_home_region,
-            's3_bucket': s3bucket,
-            's3_key': s3key,
-            'member_account': account_id,
-            'logarchive_account': logarchive_account,
-            'audit_account': audit_account,
-            'member_region': account_region,
-            'assume_role': assume_role,
-            'modify_config_recorder_success': status
-        }
+        'body': execution_context.respond(event, {
+            'modify_config_recorder_success': status,
+            'modify_config_recorder_result': result
+        })
     }
\ No newline at end of file
@@ -0,0 +1,96 @@
+import os
+import time
+import logging
+import threading
+
+#
+# In-memory index of the Organizations tree. It is built with one paginated
+# sweep from the root and kept at module scope for org_index_ttl_seconds, so
+# warm invocations answer OU and account lookups without calling the
+# (heavily rate-limited) Organizations API. An id missing from the index
+# triggers a rebuild at most once per org_index_miss_refresh_seconds, so a
+# batch of unknown or closed accounts costs one sweep, not one per id.
+#
+org_index_ttl_seconds = int(os.environ.get('org_index_ttl_seconds', 300))
+org_index_miss_refresh_seconds = int(os.environ.get('org_index_miss_refresh_seconds', 60))
+
+LOGGER = logging.getLogger()
+
+_index = {}
+_index_lock = threading.Lock()
+
+def _paginate(org_client, operation, key, **kwargs):
+    paginator = org_client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        for item in page[key]:
+            yield item
+
+def build_index(org_client):
+    roots = list(_paginate(org_client, 'list_roots', 'Roots'))
+    parents = {}
+    child_ous = {}
+    ou_accounts = {}
+    pending = [ root['Id'] for root in roots ]
+    while pending:
+        parent_id = pending.pop()
+        child_ous[parent_id] = []
+        ou_accounts[parent_id] = []
+        for ou in _paginate(org_client, 'list_organizational_units_for_parent', 'OrganizationalUnits', ParentId=parent_id):
+            parents[ou['Id']] = parent_id
+            child_ous[parent_id].append(ou['Id'])
+            pending.append(ou['Id'])
+        for account in _paginate(org_client, 'list_accounts_for_parent', 'Accounts', ParentId=parent_id):
+            parents[account['Id']] = parent_id
+            ou_accounts[parent_id].append(account['Id'])
+    LOGGER.info(f"Indexed {len(child_ous)} Organization parents and {len(parents)} children")
+    return {
+        'roots': set([ root['Id'] for root in roots ]),
+        'parents': parents,
+        'child_ous': child_ous,
+        'ou_accounts': ou_accounts,
+        'built_at': time.time()
+    }
+
+def get_index(org_client, refresh=False, min_age=0):
+    # refresh rebuilds an index older than min_age seconds
+    with _index_lock:
+        age = time.time() - _index['built_at'] if _index else None
+        expired = age is None or age > org_index_ttl_seconds
+        if expired or (refresh and age >= min_age):
+            _index.clear()
+            _index.update(build_index(org_client))
+        return _index
+
+def invalidate():
+    with _index_lock:
+        _index.clear()
+
+def ou_exists(org_client, ou_id):
+    index = get_index(org_client)
+    return ou_id in index['child_ous'] and ou_id not in index['roots']
+
+def get_parent(org_client, child_id):
+    # returns (parent_id, parent_type) like list_parents(..)
+    index = get_index(org_client)
+    parent_id = index['parents'].get(child_id)
+    if parent_id is None:
+        # the account may have joined or moved after the index was built;
+        # a recent index is trusted, so repeated misses do not sweep again
+        index = get_index(org_client, refresh=True, min_age=org_index_miss_refresh_seconds)
+        parent_id = index['parents'].get(child_id)
+    if parent_id is None:
+        return (None, None)
+    if parent_id in index['roots']:
+        return (parent_id, 'ROOT')
+    return (parent_id, 'ORGANIZATIONAL_UNIT')
+
+def get_ou_accounts(org_client, ou_id, recursive=True):
+    index = get_index(org_client)
+    accounts = []
+    pending = [ ou_id ]
+    while pending:
+        parent_id = pending.pop(0)
+        accounts.extend(index['ou_accounts'].get(parent_id, []))
+        if recursive:
+            pending.extend(index['child_ous'].get(parent_id, []))
+    return accounts
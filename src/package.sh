@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package config_enabler.zip
 
-zip config_enabler.zip config_enabler.py
+zip config_enabler.zip config_enabler.py session_cache.py client_pool.py cell_executor.py org_index.py region_discovery.py deadline_waiter.py stackset_deployer.py region_fanout.py work_fanout.py config_state.py rate_limiter.py concurrency_controller.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package config_aggregation.zip
 
-zip config_aggregation.zip config_aggregation.py
+zip config_aggregation.zip config_aggregation.py session_cache.py client_pool.py org_index.py region_discovery.py readiness.py rate_limiter.py aggregation_reconciler.py region_fanout.py work_fanout.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package cf_roles.zip
 
-zip cf_roles.zip cf_roles.py
+zip cf_roles.zip cf_roles.py session_cache.py client_pool.py rate_limiter.py work_fanout.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package config_channel.zip
 
-zip config_channel.zip config_channel.py
+zip config_channel.zip config_channel.py session_cache.py client_pool.py org_index.py region_discovery.py readiness.py rate_limiter.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package delete_config_resources.zip
 
-zip delete_config_resources.zip delete_config_resources.py
+zip delete_config_resources.zip delete_config_resources.py session_cache.py client_pool.py region_fanout.py work_fanout.py region_discovery.py rate_limiter.py concurrency_controller.py
 
 popd > /dev/null
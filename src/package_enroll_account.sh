@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package enroll_account.zip
+
+zip enroll_account.zip enroll_account.py session_cache.py client_pool.py rate_limiter.py execution_context.py deadline_waiter.py enrollment_scheduler.py record_tracker.py
+
+popd > /dev/null
@@ -0,0 +1,10 @@
+#!/bin/bash
+SCRIPT_DIRECTORY="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
+
+pushd $SCRIPT_DIRECTORY > /dev/null
+
+rm -rf .package inventory_updater.zip
+
+zip inventory_updater.zip inventory_updater.py config_inventory.py session_cache.py client_pool.py rate_limiter.py region_discovery.py org_index.py cell_executor.py concurrency_controller.py deadline_waiter.py
+
+popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package modify_aggr_authorizations.zip
 
-zip modify_aggr_authorizations.zip modify_aggr_authorizations.py
+zip modify_aggr_authorizations.zip modify_aggr_authorizations.py session_cache.py client_pool.py region_discovery.py rate_limiter.py aggregation_reconciler.py region_fanout.py work_fanout.py execution_context.py
 
 popd > /dev/null
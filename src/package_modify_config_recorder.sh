@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package modify_config_recorder.zip
 
-zip modify_config_recorder.zip modify_config_recorder.py
+zip modify_config_recorder.zip modify_config_recorder.py session_cache.py client_pool.py org_index.py deadline_waiter.py stackset_deployer.py region_fanout.py work_fanout.py config_state.py rate_limiter.py execution_context.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package modify_delivery_channel.zip
 
-zip modify_delivery_channel.zip modify_delivery_channel.py
+zip modify_delivery_channel.zip modify_delivery_channel.py session_cache.py client_pool.py region_discovery.py config_state.py rate_limiter.py execution_context.py
 
 popd > /dev/null
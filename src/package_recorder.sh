@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package config_recorder.zip
 
-zip config_recorder.zip config_recorder.py
+zip config_recorder.zip config_recorder.py session_cache.py client_pool.py org_index.py region_discovery.py deadline_waiter.py stackset_deployer.py region_fanout.py work_fanout.py readiness.py rate_limiter.py
 
 popd > /dev/null
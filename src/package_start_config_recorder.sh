@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package start_config_recorder.zip
 
-zip start_config_recorder.zip start_config_recorder.py
+zip start_config_recorder.zip start_config_recorder.py session_cache.py client_pool.py rate_limiter.py execution_context.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package verify_cloudtrails.zip
 
-zip verify_cloudtrails.zip verify_cloudtrails.py
+zip verify_cloudtrails.zip verify_cloudtrails.py session_cache.py client_pool.py region_fanout.py work_fanout.py region_discovery.py rate_limiter.py execution_context.py
 
 popd > /dev/null
@@ -5,6 +5,6 @@ pushd $SCRIPT_DIRECTORY > /dev/null
 
 rm -rf .package verify_config_resources.zip
 
-zip verify_config_resources.zip verify_config_resources.py
+zip verify_config_resources.zip verify_config_resources.py session_cache.py client_pool.py region_discovery.py rate_limiter.py execution_context.py
 
 popd > /dev/null
@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import logging
+import threading
+from functools import partial
+
+#
+# Client side rate limiting of AWS API calls. Every pooled client gets a
+# before-send hook that takes a token from the bucket of its (service,
+# operation class, account, region) before each HTTP attempt, retries
+# included, so parallel workers share one budget per API and back off
+# before the service starts throttling. Buckets live at module scope and
+# are shared by all threads of a Lambda container.
+#
+# rate_limits overrides the defaults below with a JSON object, keys are
+# "service" or "service:class" and values are calls per second, e.g.
+#   {"config:write": 2, "organizations": 1}
+#
+default_rate = 10
+default_rate_limits = {
+    'config:read': 8,
+    'config:write': 4,
+    'organizations:read': 4,
+    'organizations:write': 2,
+    'cloudformation:read': 8,
+    'cloudformation:write': 2,
+    'servicecatalog:read': 5,
+    'servicecatalog:write': 2,
+    'cloudtrail:read': 5,
+    'cloudtrail:write': 2,
+    'iam:read': 10,
+    'iam:write': 5,
+    'sts:read': 20,
+    'sts:write': 20
+}
+read_prefixes = ('Describe', 'List', 'Get', 'BatchGet', 'Lookup', 'Search')
+throttle_error_codes = ('Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded')
+
+LOGGER = logging.getLogger()
+
+def _load_rate_limits():
+    rate_limits = dict(default_rate_limits)
+    try:
+        rate_limits.update(json.loads(os.environ.get('rate_limits', '{}')))
+    except ValueError as ex:
+        LOGGER.error(f"Ignoring invalid rate_limits: {str(ex)}")
+    return rate_limits
+
+rate_limits = _load_rate_limits()
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_throttle_listeners = []
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # blocks until a token is available, returns the seconds waited
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+def operation_class(operation_name):
+    if operation_name.startswith(read_prefixes):
+        return 'read'
+    return 'write'
+
+def get_rate(service_name, op_class):
+    rate = rate_limits.get(f"{service_name}:{op_class}")
+    if rate is None:
+        rate = rate_limits.get(service_name, default_rate)
+    return rate
+
+def get_bucket(service_name, op_class, account_id, region):
+    key = (service_name, op_class, account_id, region)
+    with _buckets_lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(get_rate(service_name, op_class))
+            _buckets[key] = bucket
+    return bucket
+
+def _before_send(service_name, account_id, region, event_name=None, **kwargs):
+    # event_name: before-send.<service id>.<operation name>
+    operation_name = event_name.split('.')[-1]
+    op_class = operation_class(operation_name)
+    waited = get_bucket(service_name, op_class, account_id, region).acquire()
+    if waited > 1:
+        LOGGER.info(f"Rate limited {service_name}.{operation_name} for Account {account_id} in Region {region} by {waited:.1f}s")
+
+def _needs_retry(service_name, response=None, event_name=None, **kwargs):
+    # only observes throttled attempts, the retry decision stays with botocore
+    if response is None:
+        return None
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in throttle_error_codes:
+        operation_name = event_name.split('.')[-1]
+        for listener in list(_throttle_listeners):
+            listener(service_name, operation_name)
+    return None
+
+def is_throttle_error(ex):
+    # a ClientError that still throttled after botocore's retries
+    response = getattr(ex, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in throttle_error_codes
+
+def add_throttle_listener(listener):
+    # listener(service_name, operation_name) is called on every throttled attempt
+    _throttle_listeners.append(listener)
+
+def remove_throttle_listener(listener):
+    if listener in _throttle_listeners:
+        _throttle_listeners.remove(listener)
+
+def attach(client, account_id=None):
+    service_name = client.meta.service_model.service_name
+    region = client.meta.region_name
+    client.meta.events.register('before-send', partial(_before_send, service_name, account_id or 'self', region))
+    client.meta.events.register('needs-retry', partial(_needs_retry, service_name))
+    return client
+
+def reset():
+    with _buckets_lock:
+        _buckets.clear()
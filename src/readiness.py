@@ -0,0 +1,50 @@
+import logging
+import client_pool
+import session_cache
+from botocore.exceptions import ClientError
+
+#
+# Readiness probes check the preconditions of a task and raise
+# ResourceNotReadyException when they are not met yet. The state machine
+# retries that error with backoff, so a task starts as soon as IAM and
+# AWS Config have propagated instead of after a fixed Wait state.
+#
+LOGGER = logging.getLogger()
+
+class ResourceNotReadyException(Exception):
+    pass
+
+def is_readiness_check(event):
+    return bool(event.get('readiness_check', False))
+
+def probe_role_assumable(org_id, aws_account_number, role_name):
+    try:
+        member_session = session_cache.get_member_session(org_id, aws_account_number, role_name)
+        client_pool.get_client(member_session, 'sts').get_caller_identity()
+    except ClientError as ce:
+        LOGGER.info(f"Role {role_name} not assumable yet in Account {aws_account_number}: {str(ce)}")
+        raise ResourceNotReadyException(f"Role {role_name} not assumable in Account {aws_account_number}")
+    return member_session
+
+def probe_role_exists(member_session, aws_account_number, role_name):
+    # the role is read through the member session, it need not be assumable
+    iam_client = client_pool.get_client(member_session, 'iam')
+    try:
+        iam_client.get_role(RoleName=role_name)
+    except ClientError as ce:
+        LOGGER.info(f"Role {role_name} not visible yet in Account {aws_account_number}: {str(ce)}")
+        raise ResourceNotReadyException(f"Role {role_name} not found in Account {aws_account_number}")
+
+def probe_recorder_describable(member_session, aws_account_number, regions):
+    not_ready = []
+    for region in regions:
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        try:
+            response = config_client.describe_configuration_recorders()
+            if not response['ConfigurationRecorders']:
+                not_ready.append(region)
+        except ClientError as ce:
+            LOGGER.info(f"describe_configuration_recorders(..) failed for Account {aws_account_number} in Region {region}: {str(ce)}")
+            not_ready.append(region)
+    if not_ready:
+        raise ResourceNotReadyException(f"Configuration Recorder not ready for Account {aws_account_number} in Regions {not_ready}")
@@ -0,0 +1,71 @@
+import os
+import time
+import random
+import logging
+
+#
+# Tracks Service Catalog provisioning records through describe_record(..).
+# Many records are watched in one loop; the poll interval backs off while
+# nothing changes and drops back to the initial delay whenever a record
+# changes status, so a finished record is noticed within a few seconds
+# without hammering the API during long provisionings.
+#
+record_poll_initial_seconds = float(os.environ.get('record_poll_initial_seconds', 5))
+record_poll_max_seconds = float(os.environ.get('record_poll_max_seconds', 60))
+# IN_PROGRESS_IN_ERROR: Service Catalog is still rolling back
+in_progress_statuses = [ 'CREATED', 'IN_PROGRESS', 'IN_PROGRESS_IN_ERROR' ]
+
+LOGGER = logging.getLogger()
+
+def describe(sc_client, record_id):
+    # structured state of one record, outputs of all pages included
+    outputs = {}
+    kwargs = { 'Id': record_id }
+    while True:
+        response = sc_client.describe_record(**kwargs)
+        for output in response.get('RecordOutputs', []):
+            outputs[output['OutputKey']] = output.get('OutputValue')
+        if not response.get('NextPageToken'):
+            break
+        kwargs['PageToken'] = response['NextPageToken']
+    record = response['RecordDetail']
+    status = record['Status']
+    return {
+        'record_id': record_id,
+        'status': status,
+        'finished': status not in in_progress_statuses,
+        'succeeded': status == 'SUCCEEDED',
+        'provisioned_product_id': record.get('ProvisionedProductId'),
+        'provisioned_product_name': record.get('ProvisionedProductName'),
+        'errors': [ error.get('Description') for error in record.get('RecordErrors', []) ],
+        'outputs': outputs
+    }
+
+def finished_status(sc_client, record_id):
+    # None while the record is in progress
+    result = describe(sc_client, record_id)
+    return result if result['finished'] else None
+
+def watch(sc_client, record_ids, waiter):
+    # returns { record_id: state } once all records finished or the waiter
+    # deadline is reached; unfinished records keep finished == False
+    states = {}
+    unfinished = list(record_ids)
+    delay = record_poll_initial_seconds
+    while unfinished:
+        changed = False
+        for record_id in list(unfinished):
+            state = describe(sc_client, record_id)
+            previous = states.get(record_id)
+            if previous is None or previous['status'] != state['status']:
+                changed = True
+                LOGGER.info(f"Record {record_id} is {state['status']}")
+            states[record_id] = state
+            if state['finished']:
+                unfinished.remove(record_id)
+        remaining = waiter.remaining()
+        if not unfinished or remaining <= 0:
+            break
+        delay = record_poll_initial_seconds if changed else min(record_poll_max_seconds, delay * 2)
+        time.sleep(min(random.uniform(delay / 2, delay), remaining))
+    return states
@@ -0,0 +1,71 @@
+import os
+import time
+import logging
+import threading
+import client_pool
+
+#
+# Control Tower governed regions are derived from the stack instances of a
+# Control Tower baseline StackSet. The result is cached at module scope for
+# ct_regions_ttl_seconds, so warm invocations skip the CloudFormation calls.
+#
+ct_regions_ttl_seconds = int(os.environ.get('ct_regions_ttl_seconds', 900))
+ct_baseline_stackset_name = 'AWSControlTowerBP-BASELINE-CLOUDWATCH'
+
+LOGGER = logging.getLogger()
+
+_regions_cache = {}
+_regions_cache_lock = threading.Lock()
+
+def list_stackset_regions(ct_session, stack_set_name, account_id=None):
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
+    kwargs = { 'StackSetName': stack_set_name }
+    if account_id:
+        kwargs['StackInstanceAccount'] = account_id
+    region_set = set()
+    paginator = cf_client.get_paginator('list_stack_instances')
+    for page in paginator.paginate(**kwargs):
+        for summary in page['Summaries']:
+            region_set.add(summary['Region'])
+    return region_set
+
+def list_enabled_regions(ct_session):
+    # without AllRegions, describe_regions(..) omits regions the account
+    # has not opted in to
+    ec2_client = client_pool.get_client(ct_session, 'ec2')
+    response = ec2_client.describe_regions(AllRegions=False)
+    return set([ region['RegionName'] for region in response['Regions'] ])
+
+def discover_regions(ct_session, stack_set_name, account_id=None):
+    region_set = set()
+    try:
+        region_set = list_stackset_regions(ct_session, stack_set_name, account_id)
+    except Exception as ex:
+        LOGGER.warning("Control Tower StackSet not found in this Region")
+        LOGGER.warning(str(ex))
+        return []
+    try:
+        enabled_regions = list_enabled_regions(ct_session)
+        disabled_regions = region_set - enabled_regions
+        if disabled_regions:
+            LOGGER.warning(f"Skipping Regions not enabled for this account: {sorted(disabled_regions)}")
+        region_set = region_set & enabled_regions
+    except Exception as ex:
+        LOGGER.warning("Failed in describe_regions(..), Region opt-in status not checked")
+        LOGGER.warning(str(ex))
+    return sorted(region_set)
+
+def get_ct_regions(ct_session, stack_set_name=ct_baseline_stackset_name, account_id=None, refresh=False):
+    key = (stack_set_name, account_id)
+    with _regions_cache_lock:
+        cached = _regions_cache.get(key)
+        if cached and not refresh and time.time() - cached[0] <= ct_regions_ttl_seconds:
+            return list(cached[1])
+    ct_regions = discover_regions(ct_session, stack_set_name, account_id)
+    # a failed discovery is not cached, so the next call retries it
+    if ct_regions:
+        with _regions_cache_lock:
+            _regions_cache[key] = (time.time(), ct_regions)
+    LOGGER.info(f"Control Tower Region Count: {len(ct_regions)}")
+    LOGGER.info(f"Control Tower Regions: {ct_regions}")
+    return list(ct_regions)
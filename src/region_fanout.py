@@ -0,0 +1,46 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import work_fanout
+
+#
+# Runs one function per region on a thread pool. Regions are independent
+# AWS endpoints, so the wall time of a sweep follows the slowest region
+# instead of the sum of all of them.
+#
+default_region_workers = int(os.environ.get('region_workers', 8))
+
+LOGGER = logging.getLogger()
+
+def map_regions(func, regions, max_workers=None):
+    # returns { region: func(region) }; the first failing region cancels
+    # all regions not yet started and its exception is raised
+    if max_workers is None:
+        max_workers = default_region_workers
+    results = {}
+    if max_workers <= 1 or len(regions) <= 1:
+        for region in regions:
+            results[region] = func(region)
+        return results
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(regions)))
+    futures = {}
+    try:
+        futures = { executor.submit(func, region): region for region in regions }
+        for future in as_completed(futures):
+            region = futures[future]
+            results[region] = future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=False)
+    return results
+
+def map_regions_collect(func, regions, max_workers=None, controller=None):
+    # like map_regions, but every region runs to completion; returns
+    # ({ region: result }, { region: exception }). An optional concurrency
+    # controller limits the regions in flight below max_workers.
+    if max_workers is None:
+        max_workers = default_region_workers
+    return work_fanout.map_collect(regions, func, max_workers, controller, label='Region')
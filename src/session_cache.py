@@ -0,0 +1,140 @@
+import os
+import boto3
+import logging
+import threading
+from datetime import datetime, timezone
+from botocore.credentials import CredentialProvider, CredentialResolver, DeferredRefreshableCredentials
+from botocore.session import get_session
+
+#
+# Assumed-role sessions are cached at module scope so that they survive
+# warm Lambda invocations. botocore refreshes the credentials of a cached
+# session once they enter its advisory refresh window (15 minutes before
+# expiry). refresh_ahead_seconds before expiry the next role is assumed on
+# a background thread instead, so that botocore's refresh on the request
+# path only picks up the prefetched credentials.
+#
+assume_role_duration_seconds = int(os.environ.get('assume_role_duration_seconds', 3600))
+refresh_ahead_seconds = int(os.environ.get('refresh_ahead_seconds', 1200))
+
+LOGGER = logging.getLogger()
+
+_session_cache = {}
+_session_cache_lock = threading.Lock()
+_session_locks = {}
+_session_accounts = {}
+_session_refresh = {}
+_caller_identity = {}
+
+def get_caller_identity():
+    # management account identity does not change within a container
+    if not _caller_identity:
+        _caller_identity.update(boto3.client('sts').get_caller_identity())
+    return _caller_identity
+
+def get_partition():
+    return get_caller_identity()['Arn'].split(":")[1]
+
+def get_account_id():
+    return get_caller_identity()['Account']
+
+class MemberCredentialProvider(CredentialProvider):
+    # hands the refreshable credentials of a member account to botocore
+    METHOD = 'sts-assume-role'
+
+    def __init__(self, credentials):
+        super().__init__()
+        self.credentials = credentials
+
+    def load(self):
+        return self.credentials
+
+def _assume_role_refresher(aws_account_number, role_name, external_id):
+    role_arn = 'arn:%s:iam::%s:role/%s' % (
+        get_partition(), aws_account_number, role_name
+    )
+    def refresh():
+        sts_client = boto3.client('sts')
+        response = sts_client.assume_role(
+            RoleArn=role_arn,
+            RoleSessionName=str(aws_account_number+'-'+role_name),
+            ExternalId=external_id,
+            DurationSeconds=assume_role_duration_seconds
+        )
+        LOGGER.info(f"Assumed Role {role_name} in Account {aws_account_number}")
+        return {
+            'access_key': response['Credentials']['AccessKeyId'],
+            'secret_key': response['Credentials']['SecretAccessKey'],
+            'token': response['Credentials']['SessionToken'],
+            'expiry_time': response['Credentials']['Expiration'].isoformat()
+        }
+    return refresh
+
+def _seconds_left(expiry_time):
+    return (datetime.fromisoformat(expiry_time) - datetime.now(timezone.utc)).total_seconds()
+
+def _prefetching_refresher(state, fetch):
+    # hands out credentials prefetched in the background, if any
+    def refresh():
+        with _session_cache_lock:
+            metadata = state.pop('prefetched', None)
+            current_expiry_time = state.get('expiry_time')
+        # prefetched credentials must outlive the ones they replace
+        if metadata is None or _seconds_left(metadata['expiry_time']) <= _seconds_left(current_expiry_time):
+            metadata = fetch()
+        with _session_cache_lock:
+            state['expiry_time'] = metadata['expiry_time']
+        return metadata
+    return refresh
+
+def _prefetch(state, fetch, aws_account_number):
+    try:
+        metadata = fetch()
+        with _session_cache_lock:
+            state['prefetched'] = metadata
+    except Exception as ex:
+        # botocore refreshes on the request path instead
+        LOGGER.warning(f"Background refresh failed for Account {aws_account_number}: {str(ex)}")
+    finally:
+        with _session_cache_lock:
+            state['prefetching'] = False
+
+def _refresh_ahead(key, aws_account_number):
+    with _session_cache_lock:
+        state = _session_refresh.get(key)
+        if state is None or state['prefetching'] or 'prefetched' in state:
+            return
+        if _seconds_left(state['expiry_time']) > refresh_ahead_seconds:
+            return
+        state['prefetching'] = True
+    LOGGER.info(f"Refreshing credentials of Account {aws_account_number} in the background")
+    threading.Thread(target=_prefetch, args=(state, state['fetch'], aws_account_number), daemon=True).start()
+
+def get_member_session(external_id, aws_account_number, role_name):
+    key = (aws_account_number, role_name, external_id)
+    # one lock per key so that different accounts assume roles concurrently
+    with _session_cache_lock:
+        key_lock = _session_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        member_session = _session_cache.get(key)
+        if member_session is not None:
+            LOGGER.info(f"Using cached session for Account {aws_account_number}")
+            _refresh_ahead(key, aws_account_number)
+            return member_session
+        fetch = _assume_role_refresher(aws_account_number, role_name, external_id)
+        state = { 'fetch': fetch, 'prefetching': False }
+        refresh = _prefetching_refresher(state, fetch)
+        credentials = DeferredRefreshableCredentials(refresh_using=refresh, method='sts-assume-role')
+        # assumes the role now, so that failures surface here
+        credentials.get_frozen_credentials()
+        botocore_session = get_session()
+        botocore_session.register_component('credential_provider', CredentialResolver([ MemberCredentialProvider(credentials) ]))
+        member_session = boto3.Session(botocore_session=botocore_session)
+        _session_cache[key] = member_session
+        _session_refresh[key] = state
+        _session_accounts[id(credentials)] = aws_account_number
+    return member_session
+
+def get_session_account(client_session):
+    # member account of a cached session, None for the Lambda's own session
+    return _session_accounts.get(id(client_session.get_credentials()))
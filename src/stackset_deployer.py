@@ -0,0 +1,130 @@
+import os
+import json
+import logging
+import client_pool
+import deadline_waiter
+import work_fanout
+
+#
+# Plans StackSet instance deployments so that all Organizational Units
+# sharing a set of regions are covered by one create_stack_instances(..)
+# operation per StackSet, deployed to all regions in parallel. Operations
+# on one StackSet cannot overlap and run back to back; different StackSets
+# are deployed concurrently.
+#
+stackset_max_concurrent_percentage = int(os.environ.get('stackset_max_concurrent_percentage', 100))
+stackset_failure_tolerance_percentage = int(os.environ.get('stackset_failure_tolerance_percentage', 10))
+in_progress_instance_statuses = [ 'PENDING', 'RUNNING' ]
+
+LOGGER = logging.getLogger()
+
+class StackSetDeploymentFailed(Exception):
+    pass
+
+def operation_preferences():
+    return {
+        'RegionConcurrencyType': 'PARALLEL',
+        'MaxConcurrentPercentage': stackset_max_concurrent_percentage,
+        'FailureTolerancePercentage': stackset_failure_tolerance_percentage
+    }
+
+def plan_deployments(targets):
+    # targets: [ (stack_set_name, ou_id, region) ]
+    # returns one operation per (StackSet, set of regions) covering every OU
+    # that is targeted in exactly those regions
+    ou_regions = {}
+    for (stack_set_name, ou_id, region) in targets:
+        ou_regions.setdefault((stack_set_name, ou_id), set()).add(region)
+    operations = {}
+    for (stack_set_name, ou_id), regions in ou_regions.items():
+        key = (stack_set_name, tuple(sorted(regions)))
+        operations.setdefault(key, []).append(ou_id)
+    plan = []
+    for (stack_set_name, regions), ou_ids in sorted(operations.items()):
+        plan.append({
+            'StackSetName': stack_set_name,
+            'OrganizationalUnitIds': sorted(ou_ids),
+            'Regions': list(regions)
+        })
+    LOGGER.info(f"StackSet deployment plan: {json.dumps(plan)}")
+    return plan
+
+def get_operation_status(cf_client, stack_set_name, operation_id):
+    response = cf_client.describe_stack_set_operation(StackSetName=stack_set_name, OperationId=operation_id)
+    status = response['StackSetOperation']['Status']
+    if status in ('SUCCEEDED', 'FAILED', 'STOPPED'):
+        return status
+    return None
+
+def deploy_stack_set(cf_client, operations, waiter):
+    # operations on one StackSet cannot overlap, so they run back to back
+    operation_ids = []
+    for operation in operations:
+        stack_set_name = operation['StackSetName']
+        response = cf_client.create_stack_instances(
+            StackSetName=stack_set_name,
+            DeploymentTargets={
+                'OrganizationalUnitIds': operation['OrganizationalUnitIds']
+            },
+            Regions=operation['Regions'],
+            OperationPreferences=operation_preferences(),
+            CallAs='SELF'
+        )
+        operation_id = response['OperationId']
+        LOGGER.info(f"StackSet {stack_set_name} launched for {len(operation['OrganizationalUnitIds'])} Organizational Units in {len(operation['Regions'])} Regions with Operation Id: {operation_id}")
+        status = waiter.wait(lambda: get_operation_status(cf_client, stack_set_name, operation_id), f"StackSet {stack_set_name} Operation {operation_id}")
+        if status != 'SUCCEEDED':
+            raise StackSetDeploymentFailed(f"StackSet {stack_set_name} Operation {operation_id} ended with status: {status}")
+        operation_ids.append(operation_id)
+    return operation_ids
+
+def deploy(ct_session, plan, waiter=None):
+    # returns the operation ids in plan order; every StackSet runs to
+    # completion before a failure is raised
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
+    stack_set_operations = {}
+    for operation in plan:
+        stack_set_operations.setdefault(operation['StackSetName'], []).append(operation)
+    (results, errors) = work_fanout.map_collect(
+        sorted(stack_set_operations),
+        lambda stack_set_name: deploy_stack_set(cf_client, stack_set_operations[stack_set_name], waiter),
+        label='StackSet'
+    )
+    if errors:
+        raise StackSetDeploymentFailed('; '.join([ str(errors[stack_set_name]) for stack_set_name in sorted(errors) ]))
+    operation_ids = []
+    for operation in plan:
+        operation_ids.append(results[operation['StackSetName']].pop(0))
+    return operation_ids
+
+def get_instance_statuses(cf_client, stack_set_name, region):
+    # returns { account: detailed status } of all instances in the region
+    statuses = {}
+    paginator = cf_client.get_paginator('list_stack_instances')
+    for page in paginator.paginate(StackSetName=stack_set_name, StackInstanceRegion=region, CallAs='SELF'):
+        for summary in page['Summaries']:
+            statuses[summary['Account']] = summary.get('StackInstanceStatus', {}).get('DetailedStatus')
+    return statuses
+
+def wait_for_instances(ct_session, stack_set_names, accounts, region, waiter=None):
+    # waits on the instances of all accounts together, one listing per
+    # StackSet and check; returns { (stack_set_name, account): detailed
+    # status }, None for instances unfinished at the deadline
+    waiter = waiter or deadline_waiter.Waiter()
+    cf_client = client_pool.get_client(ct_session, 'cloudformation')
+    pending = set([ (stack_set_name, account) for stack_set_name in stack_set_names for account in accounts ])
+    statuses = {}
+    def check():
+        for stack_set_name in sorted(set([ key[0] for key in pending ])):
+            current = get_instance_statuses(cf_client, stack_set_name, region)
+            for key in [ key for key in pending if key[0] == stack_set_name ]:
+                status = current.get(key[1])
+                if status and status not in in_progress_instance_statuses:
+                    statuses[key] = status
+                    pending.discard(key)
+        return not pending
+    waiter.wait(check, f"{len(pending)} StackSet instances in Region {region}")
+    for key in pending:
+        statuses[key] = None
+    return statuses
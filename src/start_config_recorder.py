@@ -9,6 +9,9 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import execution_context
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -30,28 +33,13 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print("Assumed region_session for Account {}".format(aws_account_number))
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
 
 def start_config_recorder(member_session, aws_account_number, region):
     status = False
     LOGGER.info(f"Starting Config Recorder for Account: {aws_account_number} in Region: {region} ..")
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_configuration_recorders()
         if response['ConfigurationRecorders']:
             for recorder in response['ConfigurationRecorders']:
@@ -69,6 +57,7 @@ def start_config_recorder(member_session, aws_account_number, region):
 
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    event = execution_context.resolve(event)
     org_id = event['org_id']
     ou_id = event['org_unit_id']
     ct_home_region = event['ct_home_region']
@@ -83,17 +72,7 @@ def lambda_handler(event, context):
     status = start_config_recorder(member_session, account_id, account_region)
     return {
         'statusCode': 200,
-        'body': {
-            'org_id': org_id,
-            'org_unit_id': ou_id,
-            'ct_home_region': ct_home_region,
-            's3_bucket': s3bucket,
-            's3_key': s3key,
-            'member_account': account_id,
-            'logarchive_account': logarchive_account,
-            'audit_account': audit_account,
-            'member_region': account_region,
-            'assume_role': role_name,
+        'body': execution_context.respond(event, {
             'start_config_recorder_success': status
-        }
+        })
     }
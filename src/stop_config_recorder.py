@@ -8,6 +8,9 @@ import urllib3
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import region_discovery
 
 session = boto3.Session()
 ct_config_recorder_name = 'aws-controltower-BaselineConfigRecorder'
@@ -21,42 +24,15 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=os.environ['org_id']
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    print("Assumed region_session for Account {}".format(aws_account_number))
-    return sts_session
+    return session_cache.get_member_session(os.environ['org_id'], aws_account_number, role_name)
 
 def get_ct_regions(ct_session):
-    cf = ct_session.client('cloudformation')
-    region_set = set()
-    try:
-        # stack instances are outdated
-        stacks = cf.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        print("Control Tower StackSet not found in this Region")
-        print(str(ex))
-    print("Control Tower Regions: {}".format(list(region_set)))
-    return list(region_set)
+    return region_discovery.get_ct_regions(ct_session)
 
 def start_config_recorder(member_session, aws_account_number, region):
     print("Stopping Config Recorder for Account: {} in Region: {} ..".format(aws_account_number, region))
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_configuration_recorders()
         if response['ConfigurationRecorders']:
             for recorder in response['ConfigurationRecorders']:
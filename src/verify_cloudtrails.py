@@ -8,6 +8,19 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import execution_context
+import region_discovery
+import region_fanout
+
+# region: list_trails(..) in every region
+# account: one list_trails(..) and one describe_trails(..) per account
+# organization: accounts covered by a logging organization trail of the
+#               management account are reported with trail_coverage
+#               organization and no trail_count, without assuming a member
+#               role; otherwise as account
+trail_check_mode = os.environ.get('trail_check_mode', 'account')
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -27,44 +40,16 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
 
 def get_ct_regions(account_id):
-    cf = session.client('cloudformation')
-    region_set = set()
-    try:
-        paginator = cf.get_paginator('list_stack_instances')
-        iterator = paginator.paginate(StackSetName='AWSControlTowerBP-BASELINE-CONFIG', StackInstanceAccount=account_id)
-        for page in iterator:
-            for summary in page['Summaries']:
-                region_set.add(summary['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.warning(str(ex))
-    LOGGER.info(f"Control Tower Region Count: {str(len(list(region_set)))}")
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return region_discovery.get_ct_regions(session, 'AWSControlTowerBP-BASELINE-CONFIG', account_id)
 
 def get_cloudtrails(member_session, account_id, region):
     LOGGER.info(f"Get CloudTrails for Account: {account_id} in Region: {region} ..")
     cloud_trails = 0
     try:
-        trail_client = member_session.client('cloudtrail', endpoint_url=f"https://cloudtrail.{region}.amazonaws.com", region_name=region)
+        trail_client = client_pool.get_client(member_session, 'cloudtrail', endpoint_url=f"https://cloudtrail.{region}.amazonaws.com", region_name=region)
         paginator = trail_client.get_paginator('list_trails')
         iterator = paginator.paginate()
         for page in iterator:
@@ -76,8 +61,54 @@ def get_cloudtrails(member_session, account_id, region):
         raise VerifyFailedException('failed to verify cloudtrails for Account: {} in Region: {}'.format(account_id, region))
     return cloud_trails
 
+def bucket_trails_by_region(trails, multi_region_trails, regions):
+    # a multi-region trail counts in every region, any other trail in its home region
+    trail_counts = { region: 0 for region in regions }
+    for trail in trails:
+        if trail['TrailARN'] in multi_region_trails:
+            for region in trail_counts:
+                trail_counts[region] += 1
+        elif trail.get('HomeRegion') in trail_counts:
+            trail_counts[trail['HomeRegion']] += 1
+    return trail_counts
+
+def get_account_cloudtrails(member_session, account_id, regions, home_region):
+    LOGGER.info(f"Get CloudTrails for Account: {account_id} in {len(regions)} Regions ..")
+    try:
+        trail_client = client_pool.get_client(member_session, 'cloudtrail', endpoint_url=f"https://cloudtrail.{home_region}.amazonaws.com", region_name=home_region)
+        # list_trails(..) returns the trails of all regions with their HomeRegion
+        trails = []
+        paginator = trail_client.get_paginator('list_trails')
+        for page in paginator.paginate():
+            trails.extend(page['Trails'])
+        # multi-region trails are shadowed into every region, including this one
+        response = trail_client.describe_trails(includeShadowTrails=True)
+        multi_region_trails = set([ trail['TrailARN'] for trail in response['trailList'] if trail.get('IsMultiRegionTrail') ])
+    except Exception as ex:
+        LOGGER.error(f"Failed in list_trails(..) / describe_trails(..) for Account: {account_id}")
+        LOGGER.error(str(ex))
+        raise VerifyFailedException('failed to verify cloudtrails for Account: {}'.format(account_id))
+    return bucket_trails_by_region(trails, multi_region_trails, regions)
+
+def get_organization_trails(home_region):
+    # logging multi-region organization trails of the management account
+    org_trails = []
+    try:
+        trail_client = client_pool.get_client(session, 'cloudtrail', endpoint_url=f"https://cloudtrail.{home_region}.amazonaws.com", region_name=home_region)
+        response = trail_client.describe_trails(includeShadowTrails=True)
+        for trail in response['trailList']:
+            if trail.get('IsOrganizationTrail') and trail.get('IsMultiRegionTrail'):
+                if trail_client.get_trail_status(Name=trail['TrailARN'])['IsLogging']:
+                    org_trails.append(trail['TrailARN'])
+    except Exception as ex:
+        LOGGER.warning(f"Organization trail lookup failed, checking member account trails")
+        LOGGER.warning(str(ex))
+    return org_trails
+
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    # the shared fields are stored once, region items carry a context_key
+    event = execution_context.share(execution_context.resolve(event))
     org_id = event['org_id']
     ou_id = event['org_unit_id']
     ct_home_region = event['ct_home_region']
@@ -88,26 +119,45 @@ def lambda_handler(event, context):
     audit_account = event['audit_account']    
     assume_role_name = event['assume_role']
     ct_regions = get_ct_regions(audit_account)
-    member_session = assume_role(org_id, account_id, assume_role_name)
+    # fleet mode passes the regions of one manifest cell
+    member_regions = event.get('member_regions')
+    if member_regions:
+        skipped_regions = sorted(set(member_regions) - set(ct_regions))
+        if skipped_regions:
+            LOGGER.warning(f"Skipping Regions not governed by Control Tower: {skipped_regions}")
+        ct_regions = [ region for region in ct_regions if region in member_regions ]
+    mode = event.get('trail_check_mode', trail_check_mode)
     region_cloudtrails = []
-    for region in ct_regions:
-        try:
-            cloudtrail_count = get_cloudtrails(member_session, account_id, region)
-            region_cloudtrails.append({ 
-                'org_id': org_id,
-                'org_unit_id': ou_id,
-                'ct_home_region': ct_home_region,
-                's3_bucket': s3bucket,
-                's3_key': s3key,
-                'trail_count': cloudtrail_count,
-                'member_account': account_id,
-                'member_region': region,
-                'logarchive_account': logarchive_account,
-                'audit_account': audit_account,
-                'assume_role': assume_role_name
-            })
-        except VerifyFailedException as vfe:
-            raise vfe
+    if mode == 'organization':
+        org_trails = get_organization_trails(ct_home_region)
+        if org_trails:
+            # covered: the state machine skips the trail_count check
+            LOGGER.info(f"Account {account_id} covered by Organization trails: {org_trails}")
+            for region in sorted(ct_regions):
+                region_cloudtrails.append(execution_context.respond(event, {
+                    'trail_coverage': 'organization',
+                    'member_region': region
+                }))
+            return {
+                'statusCode': 200,
+                'body': {
+                    'region_cloudtrails': region_cloudtrails
+                }
+            }
+    member_session = assume_role(org_id, account_id, assume_role_name)
+    if mode == 'region':
+        # VerifyFailedException of any region fails the whole verification
+        trail_counts = region_fanout.map_regions(
+            lambda region: get_cloudtrails(member_session, account_id, region),
+            ct_regions)
+    else:
+        trail_counts = get_account_cloudtrails(member_session, account_id, ct_regions, ct_home_region)
+    for region in sorted(trail_counts):
+        region_cloudtrails.append(execution_context.respond(event, {
+            'trail_count': trail_counts[region],
+            'trail_coverage': 'account',
+            'member_region': region
+        }))
     return {
         'statusCode': 200,
         'body': {
@@ -8,6 +8,10 @@ import logging
 from datetime import date, datetime
 import time
 from botocore.exceptions import ClientError
+import session_cache
+import client_pool
+import execution_context
+import region_discovery
 
 LOGGER = logging.getLogger()
 if 'log_level' in os.environ:
@@ -27,43 +31,16 @@ def json_serial(obj):
     raise TypeError('Type %s not serializable' % type(obj))
 
 def assume_role(org_id, aws_account_number, role_name):
-    sts_client = boto3.client('sts')
-    partition = sts_client.get_caller_identity()['Arn'].split(":")[1]
-    response = sts_client.assume_role(
-        RoleArn='arn:%s:iam::%s:role/%s' % (
-            partition, aws_account_number, role_name
-        ),
-        RoleSessionName=str(aws_account_number+'-'+role_name),
-        ExternalId=org_id
-    )
-    sts_session = boto3.Session(
-        aws_access_key_id=response['Credentials']['AccessKeyId'],
-        aws_secret_access_key=response['Credentials']['SecretAccessKey'],
-        aws_session_token=response['Credentials']['SessionToken']
-    )
-    LOGGER.info(f"Assumed region_session for Account {aws_account_number}")
-    return sts_session
+    return session_cache.get_member_session(org_id, aws_account_number, role_name)
 
 def get_ct_regions():
-    cf = session.client('cloudformation')
-    region_set = set()
-    try:
-        # stack instances are outdated
-        stacks = cf.list_stack_instances(
-            StackSetName='AWSControlTowerBP-BASELINE-CLOUDWATCH')
-        for stack in stacks['Summaries']:
-            region_set.add(stack['Region'])
-    except Exception as ex:
-        LOGGER.warning("Control Tower StackSet not found in this Region")
-        LOGGER.warning(str(ex))
-    LOGGER.info(f"Control Tower Regions: {list(region_set)}")
-    return list(region_set)
+    return region_discovery.get_ct_regions(session)
 
 def get_config_recorders(member_session, aws_account_number, region):
     LOGGER.info(f"Configuration Recorders for Region: {region}")
     config_recorders = []
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_configuration_recorders()
         if response['ConfigurationRecorders']:
             for recorder in response['ConfigurationRecorders']:
@@ -78,7 +55,7 @@ def get_delivery_channels(member_session, aws_account_number, region):
     LOGGER.info(f"Delivery Channels for Region: {region}")
     delivery_channels = []
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_delivery_channels()
         if response['DeliveryChannels']:
             for channel in response['DeliveryChannels']:
@@ -93,7 +70,7 @@ def get_aggregation_authorizations(member_session, aws_account_number, region):
     LOGGER.info(f"Aggregation Authorizations for Region: {region}")
     aggregation_authorizations = []
     try:
-        config_client = member_session.client('config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
+        config_client = client_pool.get_client(member_session, 'config', endpoint_url=f"https://config.{region}.amazonaws.com", region_name=region)
         response = config_client.describe_aggregation_authorizations()
         if response['AggregationAuthorizations']:
             for authorization in response['AggregationAuthorizations']:
@@ -107,6 +84,7 @@ def get_aggregation_authorizations(member_session, aws_account_number, region):
     
 def lambda_handler(event, context):
     LOGGER.info(f"REQUEST RECEIVED: {json.dumps(event, default=str)}")
+    event = execution_context.resolve(event)
     org_id = event['org_id']
     ou_id = event['org_unit_id']
     ct_home_region = event['ct_home_region']
@@ -139,19 +117,9 @@ def lambda_handler(event, context):
         raise vfe
     return {
         'statusCode': 200,
-        'body': {
-            'org_id': org_id,
-            'org_unit_id': ou_id,
-            'ct_home_region': ct_home_region,
-            's3_bucket': s3bucket,
-            's3_key': s3key,
-            'logarchive_account': logarchive_account,
-            'audit_account': audit_account,
-            'member_account': account_id,
-            'member_region': region,
-            'assume_role': assume_role_name,
+        'body': execution_context.respond(event, {
             'configuration_recorders': len(config_recorders),
             'delivery_channels': len(delivery_channels),
             'aggregation_authorizations': len(aggregation_authorizations)
-        }
+        })
     }
\ No newline at end of file
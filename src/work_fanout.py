@@ -0,0 +1,45 @@
+import os
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#
+# Runs one function per independent work item on a thread pool, e.g. per
+# StackSet or per member account. Every item runs to completion and its
+# result or exception is collected under the item.
+#
+default_fanout_workers = int(os.environ.get('fanout_workers', 8))
+
+LOGGER = logging.getLogger()
+
+def map_collect(items, func, max_workers=None, controller=None, label='Item'):
+    # returns ({ item: func(item) }, { item: exception }). An optional
+    # concurrency controller limits the items in flight below max_workers.
+    if max_workers is None:
+        max_workers = default_fanout_workers
+    results = {}
+    errors = {}
+    if not items:
+        return (results, errors)
+    max_workers = max(1, min(max_workers, len(items)))
+    pending = deque(items)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or in_flight:
+            limit = max_workers if controller is None else max(1, min(max_workers, controller.limit()))
+            while pending and len(in_flight) < limit:
+                item = pending.popleft()
+                in_flight[executor.submit(func, item)] = item
+            done, not_done = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                try:
+                    results[item] = future.result()
+                    if controller is not None:
+                        controller.on_success()
+                except Exception as ex:
+                    if controller is not None:
+                        controller.on_failure(ex)
+                    LOGGER.error(f"{label} {item} failed: {str(ex)}")
+                    errors[item] = ex
+    return (results, errors)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the Lambda sources are flat modules under src/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
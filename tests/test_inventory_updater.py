@@ -0,0 +1,201 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('boto3')
+
+import botocore.exceptions
+import config_inventory
+import inventory_updater
+
+EVENTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events')
+REGIONS = [ 'eu-west-1', 'us-east-1' ]
+
+
+def event_path(name):
+    return os.path.join(EVENTS, name)
+
+
+def scanned(account_id, region):
+    record = config_inventory.error_record(account_id, region, None)
+    record.update({ 'recorders': [], 'version': 1, 'stale': False })
+    return record
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    path = str(tmp_path / 'config_inventory.ndjson.gz')
+    inventory_updater.save_inventory({
+        ('111111111111', 'us-east-1'): scanned('111111111111', 'us-east-1'),
+        ('111111111111', 'eu-west-1'): scanned('111111111111', 'eu-west-1'),
+        ('222222222222', 'eu-west-1'): scanned('222222222222', 'eu-west-1'),
+        ('222222222222', 'us-east-1'): scanned('222222222222', 'us-east-1')
+    }, path)
+    return path
+
+
+def test_config_notifications_are_coalesced_per_cell(snapshot):
+    patched = inventory_updater.replay(snapshot, [ event_path('sqs_config_notifications.json') ], REGIONS)
+    # two notifications of one cell, one with and one without the SNS envelope,
+    # an oversized notification and an unreadable body
+    assert patched == [
+        ('111111111111', 'eu-west-1'),
+        ('111111111111', 'us-east-1'),
+        ('222222222222', 'eu-west-1')
+    ]
+    inventory = inventory_updater.load_inventory(snapshot)
+    assert inventory[('111111111111', 'us-east-1')]['version'] == 2
+    assert inventory[('111111111111', 'us-east-1')]['stale']
+    assert inventory[('222222222222', 'eu-west-1')]['last_event'] == 'OversizedConfigurationItemChangeNotification'
+    assert not inventory[('222222222222', 'us-east-1')].get('stale')
+
+
+def test_replayed_batches_bump_versions(snapshot):
+    inventory_updater.replay(snapshot, [ event_path('sqs_config_notifications.json') ] * 2, REGIONS)
+    inventory = inventory_updater.load_inventory(snapshot)
+    assert inventory[('111111111111', 'us-east-1')]['version'] == 3
+
+
+def test_notification_for_unknown_cell_adds_it(tmp_path):
+    path = str(tmp_path / 'empty.ndjson.gz')
+    patched = inventory_updater.replay(path, [ event_path('sqs_config_notifications.json') ], REGIONS)
+    inventory = inventory_updater.load_inventory(path)
+    assert sorted(inventory) == patched
+    assert all([ record['stale'] and record['version'] == 1 for record in inventory.values() ])
+
+
+def test_create_account_result_adds_all_regions(snapshot):
+    patched = inventory_updater.replay(snapshot, [ event_path('create_account_result.json') ], REGIONS)
+    assert patched == [ ('333333333333', 'eu-west-1'), ('333333333333', 'us-east-1') ]
+
+
+def test_failed_account_creation_is_ignored(snapshot):
+    assert inventory_updater.replay(snapshot, [ event_path('create_account_result_failed.json') ], REGIONS) == []
+
+
+def test_move_account_marks_known_cells(snapshot):
+    patched = inventory_updater.replay(snapshot, [ event_path('move_account.json') ], [ 'ap-southeast-2' ])
+    assert patched == [ ('111111111111', 'eu-west-1'), ('111111111111', 'us-east-1') ]
+
+
+def test_remove_account_drops_its_cells(snapshot):
+    inventory_updater.replay(snapshot, [ event_path('remove_account_from_organization.json') ], REGIONS)
+    inventory = inventory_updater.load_inventory(snapshot)
+    assert sorted(inventory) == [ ('111111111111', 'eu-west-1'), ('111111111111', 'us-east-1') ]
+
+
+def test_other_organizations_events_are_ignored(snapshot):
+    assert inventory_updater.replay(snapshot, [ event_path('invite_account_to_organization.json') ], REGIONS) == []
+
+
+def test_stale_cells_are_rescanned_on_read(snapshot):
+    inventory_updater.replay(snapshot, [ event_path('sqs_config_notifications.json') ], REGIONS)
+    inventory = inventory_updater.load_inventory(snapshot)
+    rescanned = []
+    def rescan(account_id, region):
+        rescanned.append((account_id, region))
+        return scanned(account_id, region)
+    record = inventory_updater.get_cell(inventory, '111111111111', 'us-east-1', rescan)
+    assert rescanned == [ ('111111111111', 'us-east-1') ]
+    assert record['version'] == 3 and not record['stale']
+    inventory_updater.get_cell(inventory, '222222222222', 'us-east-1', rescan)
+    assert len(rescanned) == 1
+
+
+class FakeS3:
+    # conditional put_object of one bucket; before_put runs ahead of the
+    # first put, like a writer that gets there first
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, before_put=None):
+        self.objects = {}
+        self.before_put = before_put
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        (etag, data) = self.objects[Key]
+        return { 'ETag': etag, 'Body': FakeBody(data) }
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        if self.before_put is not None:
+            (before_put, self.before_put) = (self.before_put, None)
+            before_put(self)
+        current = self.objects.get(Key)
+        if (IfMatch and (current is None or current[0] != IfMatch)) or (IfNoneMatch and current is not None):
+            raise botocore.exceptions.ClientError({ 'Error': { 'Code': 'PreconditionFailed' } }, 'PutObject')
+        self.objects[Key] = (f"etag-{len(self.objects)}-{os.urandom(4).hex()}", Body.read())
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def iter_chunks(self):
+        yield self.data
+
+
+def put_snapshot(s3_client, key, inventory, tmp_path):
+    path = str(tmp_path / 'put.ndjson.gz')
+    inventory_updater.save_inventory(inventory, path)
+    with open(path, 'rb') as snapshot:
+        s3_client.objects[key] = (f"etag-{os.urandom(4).hex()}", snapshot.read())
+
+
+def get_snapshot(s3_client, key, tmp_path):
+    path = str(tmp_path / 'get.ndjson.gz')
+    with open(path, 'wb') as snapshot:
+        snapshot.write(s3_client.objects[key][1])
+    return inventory_updater.load_inventory(path)
+
+
+def load_event(name):
+    with open(event_path(name)) as event_file:
+        return json.load(event_file)
+
+
+@pytest.fixture
+def snapshot_key(monkeypatch, tmp_path):
+    # the handler works on /tmp/<basename of the key>
+    key = f"inventory/{tmp_path.name}.ndjson.gz"
+    monkeypatch.setenv('snapshot_bucket', 'inventory-bucket')
+    monkeypatch.setenv('snapshot_key', key)
+    monkeypatch.setattr(inventory_updater.region_discovery, 'get_ct_regions', lambda session: REGIONS)
+    monkeypatch.setattr(config_inventory.time, 'sleep', lambda seconds: None)
+    yield key
+    if os.path.exists(os.path.join('/tmp', os.path.basename(key))):
+        os.remove(os.path.join('/tmp', os.path.basename(key)))
+
+
+def test_batch_is_applied_again_after_a_conflicting_write(monkeypatch, tmp_path, snapshot_key):
+    base = { ('111111111111', 'us-east-1'): scanned('111111111111', 'us-east-1') }
+    def full_scan_writes(s3_client):
+        scanned_inventory = dict(base)
+        scanned_inventory[('444444444444', 'us-east-1')] = scanned('444444444444', 'us-east-1')
+        put_snapshot(s3_client, snapshot_key, scanned_inventory, tmp_path)
+    s3_client = FakeS3(before_put=full_scan_writes)
+    put_snapshot(s3_client, snapshot_key, base, tmp_path)
+    monkeypatch.setattr(inventory_updater.client_pool, 'get_client', lambda session, service: s3_client)
+    response = inventory_updater.lambda_handler(load_event('sqs_config_notifications.json'), None)
+    assert response['body']['patched_cells'] == 3
+    inventory = get_snapshot(s3_client, snapshot_key, tmp_path)
+    # neither the full scan's cell nor the batch is lost
+    assert ('444444444444', 'us-east-1') in inventory
+    assert inventory[('111111111111', 'us-east-1')]['version'] == 2
+    assert inventory[('111111111111', 'us-east-1')]['stale']
+
+
+def test_full_scan_keeps_cells_patched_while_it_ran():
+    scan_versions = { ('111111111111', 'us-east-1'): 1, ('222222222222', 'us-east-1'): 1, ('333333333333', 'us-east-1'): 1 }
+    patched = scanned('111111111111', 'us-east-1')
+    patched.update({ 'version': 2, 'stale': True })
+    current = [ patched, scanned('222222222222', 'us-east-1'), scanned('555555555555', 'us-east-1') ]
+    records = [ config_inventory.error_record(account_id, 'us-east-1', None) for account_id in [ '111111111111', '222222222222', '333333333333' ] ]
+    merged = { config_inventory.cell_of(record): record for record in config_inventory.merge_scan(scan_versions, records)(current) }
+    assert merged[('111111111111', 'us-east-1')]['version'] == 3 and merged[('111111111111', 'us-east-1')]['stale']
+    assert merged[('222222222222', 'us-east-1')]['version'] == 2 and not merged[('222222222222', 'us-east-1')]['stale']
+    # removed from the organization while the scan ran, and not scanned
+    assert ('333333333333', 'us-east-1') not in merged
+    assert ('555555555555', 'us-east-1') in merged
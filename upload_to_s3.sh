@@ -9,6 +9,11 @@ aws s3 cp src/modify_config_recorder.zip s3://$1/
 aws s3 cp src/modify_delivery_channel.zip s3://$1/
 aws s3 cp src/modify_aggr_authorizations.zip s3://$1/
 aws s3 cp src/start_config_recorder.zip s3://$1/
+aws s3 cp src/config_inventory.zip s3://$1/
+aws s3 cp src/inventory_updater.zip s3://$1/
+aws s3 cp src/enroll_account.zip s3://$1/
+aws s3 cp inventory_notifications.yaml s3://$1/
+aws s3 cp organizations_events_forwarder.yaml s3://$1/
 aws s3 cp src/modify_config_sm4.json s3://$1/
 aws s3 cp setup-config-sf11.yaml s3://$1/
 aws s3 cp org_configrecorder.yaml s3://$1/